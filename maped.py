@@ -4,53 +4,782 @@ from tkinter import font
 from tkinter import messagebox
 from tkinter import simpledialog
 from tkinter import ttk
-from types import SimpleNamespace
+from array import array
+from copy import deepcopy
 from zipfile import ZipFile
+import argparse
 import base64
 import collections
+import concurrent.futures
+import itertools
 import json
 import math
 import pathlib
 import png
 import platform
-import re
 import struct
+import sys
 import zipfile
 
+CHUNK_PIXELS = 512 # Target width and height of rendered map chunks, in screen pixels
+CHUNK_BUDGET = 64 * 1024 * 1024 # Image memory to keep rendered map chunks in across all zoom levels, in bytes
+HASH_MODULUS = (1 << 61) - 1 # Modulus and bases of the rolling hash used to find similar map areas
+HASH_BASES = (1000003, 999983)
+UNDO_BUDGET = 16 * 1024 * 1024 # Memory to keep undo steps in, in bytes
+FORMAT_VERSION = 2 # Map file format: 1 stores everything in map.json, 2 adds binary map, tags and tiles members
+
 TAG_PALETTE = ['#edd400', '#f57900', '#c17d11', '#73d216',
                '#3465a4', '#75507b', '#cc0000', '#555753',
                '#555753']
 
-class Ctx:
-    class __serialiser__:
-        def __init__(self, ctx):
-            self.tiles = []
-            for tile in ctx.tiles:
-                self.tiles.append(base64.b64encode(tile).decode())
+def cell_runs(indices, height):
+    # Yields the cell rectangles covering runs of consecutive (sorted) cell indices in each column
+    start = None
+    for i in indices:
+        if start is None or i != end or i % height == 0:
+            if start is not None:
+                yield (start // height, start % height, start // height + 1, (end - 1) % height + 1)
+            start = i
+        end = i + 1
+    if start is not None:
+        yield (start // height, start % height, start // height + 1, (end - 1) % height + 1)
+
+def read_member(mapfile, name, values):
+    # Reads a member of a zip file straight into a buffer of the expected size
+    with mapfile.open(name) as member:
+        if member.readinto(memoryview(values).cast('B')) != memoryview(values).nbytes or member.read(1) != b'':
+            raise ValueError('Map file member %s has the wrong size' % name)
+
+class Document:
+    def __init__(self):
+        Document.reset(self)
+
+    def reset(self):
+        self.name = None # Open file name
+        self.tiles = [] # Tile store (in binary CPC pixel format)
+        self.map = array('H') # Tile map
+        self.tags = bytearray() # Tile tags map
+        self.notes = {} # Notes for cells in tile map, keyed by cell index
+        self.entity_size = 4
+        self.entities = [] # Entity list (Type, Tile X, Scroll X, Tile Y, Scroll Y, desc, [[data, desc]+])
+        self.data = [] # Cell data list ([id, data, desc]+)
+        self.palette = [] # Palette as hex values
+        self.width = 0 # Map width in tiles
+        self.height = 0 # Map height in tiles
+        self.mode = 0 # CPC screen mode
+        self.flips = False # Whether map values carry tile flips, exported in the top two bits
+        self.tile_width = 8
+        self.tile_height = 8
+        self.undo_steps = collections.deque() # Undo journal steps [bytes, [records]], oldest first
+        self.redo_steps = [] # Undone steps, most recently undone last
+        self.undo_size = 0 # Total bytes of undo steps
+        self.undo_merge = None # Merge key of the last recorded step, for coalescing repeated edits
+        self.step_depth = 0 # Nesting depth of begin_step
+        self.step = None # Step being gathered between begin_step and end_step
+        self.entity_index = None # Entity indices keyed by (tile x, tile y), built on demand
+        self.tile_uses = None # Sets of the cell indices using each tile, keyed by tile index, built on demand
+        self.tile_tags = None # Counts of the non-zero tags of the cells using each tile, keyed by tile index, built on demand
+
+    def load(self, data, mapfile=None):
+        # Loads the document from the map.json text and, from format version 2, the
+        # binary map, tags and tiles members of the open map file
+        obj = json.loads(data)
+        for attr in ['data', 'entity_size', 'entities',
+                     'palette', 'width', 'height', 'mode',
+                    'tile_width', 'tile_height']:
+            setattr(self, attr, obj[attr])
+        if obj.get('version', 1) >= 2:
+            cells = self.width * self.height
+            self.map = array('H', bytes(2 * cells)) if obj['tile_count'] > 0 else array('H')
+            self.tags = bytearray(cells)
+            read_member(mapfile, 'map.bin', self.map)
+            read_member(mapfile, 'tags.bin', self.tags)
+            if sys.byteorder == 'big':
+                self.map.byteswap()
+            tile_size = self.tile_width // len(PIXEL_BITS[self.mode]) * self.tile_height
+            tiles = bytearray(tile_size * obj['tile_count'])
+            read_member(mapfile, 'tiles.bin', tiles)
+            view = memoryview(tiles)
+            self.tiles = [bytes(view[i:i + tile_size]) for i in range(0, len(tiles), tile_size)]
+            self.notes = {int(i): note for (i, note) in obj['notes'].items()}
+        else:
+            self.tiles = [base64.b64decode(tile) for tile in obj['tiles']]
+            self.map = array('H', obj['map'])
+            self.tags = bytearray(obj['tags'])
+            self.notes = {i: note for (i, note) in enumerate(obj['notes']) if note != ''}
+        self.flips = obj.get('flips', any(value & TILE_FLIPS for value in self.map))
+        self.entity_index = None
+        self.tile_uses = None
+        self.tile_tags = None
+        self.clear_journal()
+
+    def write_json(self, file):
+        # Streams the document metadata, notes, entities and data as JSON to a binary
+        # file, one note or row per line. The map, tags and tiles are stored separately
+        fields = [('version', FORMAT_VERSION), ('tile_count', len(self.tiles)),
+                  ('notes', None), ('data', None), ('entity_size', self.entity_size), ('entities', None)] + \
+                 [(attr, getattr(self, attr)) for attr in ['palette', 'width', 'height', 'mode',
+                                                           'tile_width', 'tile_height', 'flips']]
+
+        file.write(b'{')
+        for (n, (name, value)) in enumerate(fields):
+            file.write(('%s\n    "%s": ' % (',' if n > 0 else '', name)).encode())
+            if value is not None:
+                file.write(json.dumps(value).encode())
+                continue
+            if name == 'notes':
+                rows = ['"%d": %s' % (i, json.dumps(self.notes[i])) for i in sorted(self.notes)]
+                brackets = '{}'
+            else:
+                rows = [json.dumps(row) for row in getattr(self, name)]
+                brackets = '[]'
+            file.write(brackets[0].encode())
+            for (i, row) in enumerate(rows):
+                file.write(('%s\n        %s' % (',' if i > 0 else '', row)).encode())
+            file.write((('\n    ' if len(rows) > 0 else '') + brackets[1]).encode())
+        file.write(b'\n}')
+
+    def read(self, filename):
+        with ZipFile(filename, 'r') as mapfile:
+            with mapfile.open('map.json') as mapdata:
+                self.load(mapdata.read().decode(), mapfile)
+        self.name = filename
+
+    def write(self, filename):
+        map_values = self.map
+        if sys.byteorder == 'big':
+            map_values = array('H', self.map)
+            map_values.byteswap()
+
+        # Fastest deflate level; the data compresses well regardless
+        with ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as mapfile:
+            with mapfile.open('map.json', 'w') as mapdata:
+                self.write_json(mapdata)
+            with mapfile.open('map.bin', 'w') as member:
+                member.write(map_values)
+            with mapfile.open('tags.bin', 'w') as member:
+                member.write(self.tags)
+            with mapfile.open('tiles.bin', 'w') as member:
+                for tile in self.tiles:
+                    member.write(tile)
+        self.name = filename
+
+    def resize(self, width, height):
+        # Resize the map, keeping the content of the top-left
+        rows = min(self.height, height)
+        new_map = array('H', bytes(2 * width * height))
+        new_tags = bytearray(width * height)
+        for x in range(0, min(self.width, width)):
+            i = x * self.height
+            i2 = x * height
+            if len(self.map) == len(self.tags):
+                new_map[i2:i2 + rows] = self.map[i:i + rows]
+            new_tags[i2:i2 + rows] = self.tags[i:i + rows]
+        new_notes = {}
+        for (i, note) in self.notes.items():
+            (x, y) = divmod(i, self.height)
+            if x < width and y < height:
+                new_notes[x * height + y] = note
+        self.map = new_map if len(self.tiles) > 0 else array('H')
+        self.tile_uses = None
+        self.tile_tags = None
+        self.tags = new_tags
+        self.notes = new_notes
+        self.width = width
+        self.height = height
+        self.clear_journal()
+
+    def get_tile(self, value):
+        # Returns the tile for a map value, flipped as necessary
+        if value & TILE_FLIPS == 0:
+            return self.tiles[value]
+        return flip_tile(self.tiles[value & TILE_INDEX], value, self.mode, self.tile_width)
+
+    def get_export_map(self, flips=None):
+        # Returns the map for export, with the flip flags in the top two bits of each value
+        # when flips is set (by default, when the document stores flips)
+        if not (self.flips if flips is None else flips):
+            return self.map
+        if len(self.tiles) > 64:
+            raise ValueError('Maps with flipped tiles can have at most 64 tiles')
+        return [(value & TILE_INDEX) | ((value & TILE_FLIPS) >> 8) for value in self.map]
+
+    def set_entity_size(self, size):
+        for entity in self.entities:
+            if size < self.entity_size:
+                entity[6] = entity[6][:size]
+            else:
+                entity[6] = entity[6] + [[0, ''] for x in range(size - self.entity_size)]
+        self.entity_size = size
+        self.clear_journal()
+
+    def import_map(self, filename, mode, tile_width, tile_height, replace=False, flips=False):
+        (width, height, palette, tiles, tile_map) = \
+            import_png(filename, mode, tile_width, tile_height, self.tiles if replace else [], flips)
+
+        if replace:
+            # Keep old tags and notes
+            self.resize(width, height)
+        else:
+            self.name = None
+            self.mode = mode
+            self.tile_width = tile_width
+            self.tile_height = tile_height
+            self.width = width
+            self.height = height
+            self.tags = bytearray(width * height)
+            self.notes = {}
             self.data = []
-            for datum in ctx.data_tree.get_children():
-                self.data.append(ctx.data_tree.item(datum)['values'])
-            for attr in ['map', 'tags', 'notes', 'entity_size', 'entities',
-                         'palette', 'width', 'height', 'mode',
-                        'tile_width', 'tile_height']:
-                setattr(self, attr, getattr(ctx, attr))
-
-        def __repl_func__(self, match: re.Match):
-            return " ".join(match.group().split())
-        
-        def toJSON(self):
-            return re.sub(r"(?<=\[)[^\[\]]+(?=])", self.__repl_func__,
-                json.dumps(self, default=lambda o: o.__dict__, indent=4))
+            self.entities = []
+            self.entity_index = None
+        self.palette = palette
+        self.tiles = tiles
+        self.map = tile_map
+        self.flips = flips
+        self.tile_uses = None
+        self.tile_tags = None
+        self.clear_journal()
+
+    def import_tiles(self, filename):
+        (width, height, palette, tiles, tile_map) = \
+            import_png(filename, self.mode, self.tile_width, self.tile_height)
+
+        self.begin_step()
+        if len(self.tiles) == 0:
+            self.set_attr('palette', palette)
+
+        # Add new tiles
+        new_tiles = collections.OrderedDict()
+        for tile in tiles:
+            new_tiles[tile] = len(new_tiles)
+
+        new_map = array('H', bytes(2 * self.width * self.height))
+        if len(self.map) == len(new_map):
+            for i in range(len(self.map)):
+                tile = self.tiles[self.map[i] & TILE_INDEX]
+                if tile not in new_tiles:
+                    new_tiles[tile] = len(new_tiles)
+                new_map[i] = new_tiles[tile] | (self.map[i] & TILE_FLIPS)
+
+        self.set_attr('tiles', list(new_tiles.keys()))
+        self.set_plane('map', new_map)
+        self.end_step()
+
+    def clear_journal(self):
+        self.undo_steps.clear()
+        self.redo_steps = []
+        self.undo_size = 0
+        self.undo_merge = None
+        self.journal_changed()
+
+    def journal_changed(self):
+        # Called when the undo journal changes
+        pass
+
+    def begin_step(self):
+        # Gathers the records of all edits until the matching end_step into one undo step
+        self.step_depth += 1
+        if self.step_depth == 1:
+            self.step = [0, []]
+
+    def end_step(self):
+        self.step_depth -= 1
+        if self.step_depth == 0 and len(self.step[1]) > 0:
+            self.undo_merge = None
+            self.push_step(self.step)
+
+    def record(self, records, size, merge=None):
+        # Adds journal records (kind, ..., old value, new value) of an edit taking about size
+        # bytes. Consecutive edits with the same merge key are coalesced into one undo step
+        if len(records) == 0:
+            return
+        self.index_records(records)
+        self.redo_steps = []
+        if self.step_depth > 0:
+            self.step[0] += size
+            self.step[1].extend(records)
+        elif merge is not None and merge == self.undo_merge and \
+             len(self.undo_steps) > 0 and len(self.undo_steps[-1][1]) == len(records):
+            step = self.undo_steps[-1]
+            step[1] = [old[:-1] + new[-1:] for (old, new) in zip(step[1], records)]
+            self.journal_changed()
+        else:
+            self.undo_merge = merge
+            self.push_step([size, records])
+
+    def push_step(self, step):
+        self.undo_steps.append(step)
+        self.undo_size += step[0]
+        while self.undo_size > UNDO_BUDGET and len(self.undo_steps) > 1:
+            self.undo_size -= self.undo_steps.popleft()[0]
+        self.journal_changed()
+
+    def undo(self, redo=False):
+        # Reverts (or with redo, reapplies) the last step and returns (changed cell
+        # rectangles, set of other changed attributes)
+        if len(self.redo_steps if redo else self.undo_steps) == 0:
+            return ([], set())
+        self.undo_merge = None
+        if redo:
+            step = self.redo_steps.pop()
+            self.push_step(step)
+        else:
+            step = self.undo_steps.pop()
+            self.undo_size -= step[0]
+            self.redo_steps.append(step)
+            self.journal_changed()
+
+        rects = []
+        changed = set()
+        for record in (step[1] if redo else reversed(step[1])):
+            value = record[-1] if redo else record[-2]
+            if record[0] == 'rect':
+                self.put_cells(*record[1:6], value)
+                rects.append(record[2:6])
+            elif record[0] == 'cells':
+                values = getattr(self, record[1])
+                for (i, cell) in zip(record[2], value):
+                    values[i] = cell
+                rects.extend(cell_runs(record[2], self.height))
+            elif record[0] == 'notes':
+                self.put_notes(value)
+                changed.add('notes')
+            elif record[0] == 'rows':
+                rows = getattr(self, record[1])
+                if value is None:
+                    del rows[record[2]]
+                elif (record[-2] if redo else record[-1]) is None:
+                    rows.insert(record[2], deepcopy(value))
+                else:
+                    rows[record[2]] = deepcopy(value)
+                self.rows_changed(record[1])
+                changed.add(record[1])
+            elif record[0] == 'order':
+                rows = getattr(self, record[1])
+                if redo:
+                    rows[:] = [rows[j] for j in record[2]]
+                else:
+                    old_rows = list(rows)
+                    for (i, j) in enumerate(record[2]):
+                        rows[j] = old_rows[i]
+                self.rows_changed(record[1])
+                changed.add(record[1])
+            elif record[0] == 'attr':
+                setattr(self, record[1], value[:])
+                changed.add(record[1])
+        self.index_records(step[1], not redo)
+        return (rects, changed)
+
+    def index_records(self, records, undo=False):
+        # Keeps the tile use and tile tag indices up to date with an edit (or with undo,
+        # its reversal), given its journal records
+        if self.tile_uses is None and self.tile_tags is None:
+            return
+        if len(self.map) != len(self.tags):
+            # A map without tiles has no cells to index
+            self.tile_uses = None
+            self.tile_tags = None
+            return
+        before = {}
+        for record in (reversed(records) if undo else records):
+            if record[0] == 'attr' and record[1] in ('map', 'tags'):
+                self.tile_uses = None
+                self.tile_tags = None
+                return
+            if record[0] == 'rect' and record[1] in ('map', 'tags'):
+                (x1, y1, x2, y2) = record[2:6]
+                indices = itertools.chain(*[range(x * self.height + y1, x * self.height + y2)
+                                            for x in range(x1, x2)])
+            elif record[0] == 'cells':
+                indices = record[2]
+            else:
+                continue
+            values = before.setdefault(record[1], {})
+            for (i, value) in zip(indices, record[-1] if undo else record[-2]):
+                values.setdefault(i, value)
+
+        # Work out each changed cell's tile and tag before and after the edit
+        old_tiles = before.get('map', {})
+        old_tags = before.get('tags', {})
+        for i in set(old_tiles).union(old_tags):
+            tile = self.map[i] & TILE_INDEX
+            old_tile = old_tiles.get(i, tile) & TILE_INDEX
+            if self.tile_uses is not None and old_tile != tile:
+                uses = self.tile_uses[old_tile]
+                uses.discard(i)
+                if len(uses) == 0:
+                    del self.tile_uses[old_tile]
+                self.tile_uses.setdefault(tile, set()).add(i)
+            if self.tile_tags is None:
+                continue
+            tag = self.tags[i]
+            old_tag = old_tags.get(i, tag)
+            if (old_tile, old_tag) != (tile, tag):
+                if old_tag != 0:
+                    counts = self.tile_tags[old_tile]
+                    counts[old_tag] -= 1
+                    if counts[old_tag] == 0:
+                        del counts[old_tag]
+                        if len(counts) == 0:
+                            del self.tile_tags[old_tile]
+                if tag != 0:
+                    counts = self.tile_tags.setdefault(tile, {})
+                    counts[tag] = counts.get(tag, 0) + 1
+
+    def get_cells(self, plane, x1, y1, x2, y2):
+        # Returns the map or tags values of the given cell rectangle, column by column
+        values = getattr(self, plane)
+        cells = values[0:0]
+        for x in range(x1, x2):
+            cells += values[x * self.height + y1:x * self.height + y2]
+        return cells
+
+    def put_cells(self, plane, x1, y1, x2, y2, cells):
+        values = getattr(self, plane)
+        rows = y2 - y1
+        for x in range(x1, x2):
+            i = x * self.height
+            values[i + y1:i + y2] = cells[(x - x1) * rows:(x - x1 + 1) * rows]
+
+    def record_cells(self, x1, y1, x2, y2, old, merge=None):
+        # Records the change to a cell rectangle, given its old values as {plane: cells},
+        # and returns whether anything changed
+        records = []
+        size = 0
+        for (plane, cells) in old.items():
+            new = self.get_cells(plane, x1, y1, x2, y2)
+            if new != cells:
+                records.append(('rect', plane, x1, y1, x2, y2, cells, new))
+                size += 2 * memoryview(cells).nbytes
+        self.record(records, size, merge)
+        return len(records) > 0
+
+    def set_plane(self, plane, values):
+        # Replaces the map or tags, recording only the cells that changed, and returns
+        # the changed cells as rectangles
+        old = getattr(self, plane)
+        if len(old) != len(values):
+            self.set_attr(plane, values)
+            return [(0, 0, self.width, self.height)]
+        indices = array('I', [i for i in range(len(values)) if values[i] != old[i]])
+        (old_cells, new_cells) = (values[0:0], values[0:0])
+        old_cells.extend([old[i] for i in indices])
+        new_cells.extend([values[i] for i in indices])
+        setattr(self, plane, values)
+        self.record([('cells', plane, indices, old_cells, new_cells)],
+                    memoryview(indices).nbytes + 2 * memoryview(old_cells).nbytes)
+        return list(cell_runs(indices, self.height))
+
+    def set_cells(self, plane, indices, values):
+        # Sets the map or tags values of the given (sorted) cell indices and returns the
+        # changed cells as rectangles
+        cells = getattr(self, plane)
+        old = values[0:0]
+        old.extend([cells[i] for i in indices])
+        for (i, value) in zip(indices, values):
+            cells[i] = value
+        self.record([('cells', plane, indices, old, values)], memoryview(indices).nbytes + 2 * memoryview(old).nbytes)
+        return list(cell_runs(indices, self.height))
+
+    def set_attr(self, name, value):
+        # Replaces the tiles or palette
+        old = getattr(self, name)
+        setattr(self, name, value)
+        self.record([('attr', name, old[:], value[:])], 8 * (len(old) + len(value)))
+
+    def put_notes(self, notes):
+        for (i, note) in notes.items():
+            if note != '':
+                self.notes[i] = note
+            else:
+                self.notes.pop(i, None)
+
+    def set_row(self, name, i, row):
+        # Replaces (or with None, removes) row i of the entities or data
+        rows = getattr(self, name)
+        old = rows[i]
+        if row is None:
+            del rows[i]
+        else:
+            rows[i] = row
+        self.rows_changed(name)
+        self.record([('rows', name, i, deepcopy(old), deepcopy(row))], len(repr(old)) + len(repr(row)))
+
+    def insert_row(self, name, i, row):
+        getattr(self, name).insert(i, row)
+        self.rows_changed(name)
+        self.record([('rows', name, i, None, deepcopy(row))], len(repr(row)))
+
+    def rows_changed(self, name):
+        if name == 'entities':
+            self.entity_index = None
+
+    def get_entity_index(self):
+        if self.entity_index is None:
+            self.entity_index = {}
+            for (i, entity) in enumerate(self.entities):
+                self.entity_index.setdefault((entity[1], entity[3]), []).append(i)
+        return self.entity_index
+
+    def entities_at(self, tx, ty):
+        # Returns the indices of the entities in the given tile, in order
+        return self.get_entity_index().get((tx, ty), [])
+
+    def entities_in(self, x1, y1, x2, y2):
+        # Returns the indices of the entities in the given tile rectangle (exclusive), in order
+        index = self.get_entity_index()
+        if (x2 - x1) * (y2 - y1) < len(index):
+            cells = [index.get((x, y), []) for x in range(x1, x2) for y in range(y1, y2)]
+        else:
+            cells = [entities for ((x, y), entities) in index.items() if x >= x1 and x < x2 and y >= y1 and y < y2]
+        return sorted(itertools.chain(*cells))
+
+    def reorder_rows(self, name, order):
+        # Reorders the entities or data so that new row i is old row order[i]
+        rows = getattr(self, name)
+        rows[:] = [rows[j] for j in order]
+        self.rows_changed(name)
+        self.record([('order', name, list(order))], 8 * len(order))
+
+    def copy(self, x1, y1, x2, y2, cut=False):
+        # Returns [ width, height, [tilemap], [tags] ] for the given cell rectangle (exclusive)
+        clipboard = [x2 - x1, y2 - y1, self.get_cells('map', x1, y1, x2, y2),
+                     self.get_cells('tags', x1, y1, x2, y2)]
+        if cut:
+            old = { 'tags': clipboard[3] }
+            if len(self.map) == len(self.tags):
+                self.put_cells('map', x1, y1, x2, y2, array('H', bytes(2 * len(clipboard[2]))))
+                old['map'] = clipboard[2]
+            self.put_cells('tags', x1, y1, x2, y2, bytes(len(clipboard[3])))
+            self.record_cells(x1, y1, x2, y2, old)
+        return clipboard
+
+    def paste(self, clipboard, x, y):
+        # Returns the cell rectangle that was pasted over. Tiles are only pasted when
+        # both the clipboard and this map have them
+        width = min(clipboard[0], self.width - x)
+        height = min(clipboard[1], self.height - y)
+        tiles = len(self.map) == len(self.tags) and len(clipboard[2]) == len(clipboard[3])
+        old = { 'tags': self.get_cells('tags', x, y, x + width, y + height) }
+        if tiles:
+            old['map'] = self.get_cells('map', x, y, x + width, y + height)
+        for cx in range(0, width):
+            i = (x + cx) * self.height + y
+            ci = cx * clipboard[1]
+            if tiles:
+                self.map[i:i + height] = clipboard[2][ci:ci + height]
+            self.tags[i:i + height] = clipboard[3][ci:ci + height]
+        self.record_cells(x, y, x + width, y + height, old)
+        return (x, y, x + width, y + height)
+
+    def fill(self, x1, y1, x2, y2, tile):
+        old = { 'map': self.get_cells('map', x1, y1, x2, y2) }
+        for x in range(x1, x2):
+            i = x * self.height
+            self.map[i + y1:i + y2] = array('H', [tile]) * (y2 - y1)
+        self.record_cells(x1, y1, x2, y2, old)
+
+    def set_tags(self, x1, y1, x2, y2, tag):
+        # Returns whether any tags changed
+        old = { 'tags': self.get_cells('tags', x1, y1, x2, y2) }
+        column = bytes([tag]) * (y2 - y1)
+        for x in range(x1, x2):
+            i = x * self.height
+            self.tags[i + y1:i + y2] = column
+        return self.record_cells(x1, y1, x2, y2, old, ('tags', x1, y1, x2, y2))
+
+    def set_notes(self, x1, y1, x2, y2, note):
+        old = {}
+        for x in range(x1, x2):
+            for y in range(y1, y2):
+                old[x * self.height + y] = self.notes.get(x * self.height + y, '')
+        new = { i: note for i in old }
+        self.put_notes(new)
+        if new != old:
+            self.record([('notes', old, new)], sum(map(len, old.values())) + len(note) * len(new) + 16 * len(new),
+                        ('notes', x1, y1, x2, y2))
+
+    def find_similar(self, x1, y1, x2, y2):
+        # Returns the top-left corners of all areas of the map with the same tiles as
+        # the given cell rectangle. Uses a 2D rolling hash (a hash of each vertical run
+        # of cells, then a hash of each horizontal run of those) so that the work is
+        # linear in the map size, and then checks each candidate area cell by cell
+        (width, height) = (x2 - x1, y2 - y1)
+        if width < 1 or height < 1 or width > self.width or height > self.height:
+            return []
+        (modulus, base_y, base_x) = (HASH_MODULUS, HASH_BASES[0], HASH_BASES[1])
+        (top_y, top_x) = (pow(base_y, height - 1, modulus), pow(base_x, width - 1, modulus))
+
+        # Hash every run of cells of the selection height in each column
+        column_hashes = []
+        for x in range(0, self.width):
+            column = self.map[x * self.height:(x + 1) * self.height]
+            value = 0
+            for y in range(0, height):
+                value = (value * base_y + column[y] + 1) % modulus
+            hashes = [value]
+            for y in range(0, self.height - height):
+                value = ((value - (column[y] + 1) * top_y) * base_y + column[y + height] + 1) % modulus
+                hashes.append(value)
+            column_hashes.append(hashes)
+
+        pattern = 0
+        for x in range(x1, x2):
+            pattern = (pattern * base_x + column_hashes[x][y1]) % modulus
+        selection = [self.map[x * self.height + y1:x * self.height + y2] for x in range(x1, x2)]
+
+        # Roll across each row of column hashes to find candidates
+        matches = []
+        for y in range(0, self.height - height + 1):
+            row = [hashes[y] for hashes in column_hashes]
+            value = 0
+            for x in range(0, width):
+                value = (value * base_x + row[x]) % modulus
+            for x in range(0, self.width - width + 1):
+                if x > 0:
+                    value = ((value - row[x - 1] * top_x) * base_x + row[x + width - 1]) % modulus
+                if value != pattern:
+                    continue
+                if all(self.map[(x + i) * self.height + y:(x + i) * self.height + y + height] == selection[i]
+                       for i in range(0, width)):
+                    matches.append((x, y))
+        return matches
+
+    def apply_tags_to_similar(self, x1, y1, x2, y2):
+        # Copies the tags in the given cell rectangle to all other areas of the map
+        # with the same tiles and returns the list of rectangles that were changed
+        (width, height) = (x2 - x1, y2 - y1)
+        tags = self.get_cells('tags', x1, y1, x2, y2)
+        changed = []
+        records = []
+        for (x, y) in self.find_similar(x1, y1, x2, y2):
+            # Don't check inside the selection
+            if x >= x1 and x < x2 and y >= y1 and y < y2:
+                continue
 
+            rect = (x, y, x + width, y + height)
+            old = self.get_cells('tags', *rect)
+            if old != tags:
+                self.put_cells('tags', *rect, tags)
+                records.append(('rect', 'tags', *rect, old, tags))
+                changed.append(rect)
+        self.record(records, 2 * len(tags) * len(records))
+        return changed
+
+    def get_tile_tags(self):
+        if self.tile_tags is None:
+            self.tile_tags = {}
+            for (value, tag) in zip(self.map, self.tags):
+                if tag != 0:
+                    counts = self.tile_tags.setdefault(value & TILE_INDEX, {})
+                    counts[tag] = counts.get(tag, 0) + 1
+        return self.tile_tags
+
+    def get_tile_tag(self, tile):
+        # Returns the tag of the given tile's cells. Where they conflict, this is the
+        # first non-zero tag in reading order
+        counts = self.get_tile_tags().get(tile)
+        if counts is None:
+            return 0
+        if len(counts) == 1:
+            return next(iter(counts))
+        first = min([i for i in self.get_tile_uses()[tile] if self.tags[i] != 0],
+                    key=lambda i: (i % self.height, i // self.height))
+        return self.tags[first]
+
+    def get_tag_conflicts(self):
+        # Returns the tiles whose cells have more than one different non-zero tag, in order
+        return sorted([tile for (tile, counts) in self.get_tile_tags().items() if len(counts) > 1])
+
+    def get_unique_cell_tags(self):
+        return {tile: self.get_tile_tag(tile) for tile in self.get_tile_uses()}
+
+    def dedupe_cell_tags(self):
+        # Returns the list of rectangles that were changed
+        uses = self.get_tile_uses()
+        indices = []
+        tags = bytearray()
+        for (tile, counts) in self.get_tile_tags().items():
+            if len(counts) == 1 and next(iter(counts.values())) == len(uses[tile]):
+                continue
+            tag = self.get_tile_tag(tile)
+            changed = [i for i in uses[tile] if self.tags[i] != tag]
+            indices.extend(changed)
+            tags.extend([tag] * len(changed))
+        if len(indices) == 0:
+            return []
+        order = sorted(range(len(indices)), key=indices.__getitem__)
+        return self.set_cells('tags', array('I', [indices[j] for j in order]), bytearray([tags[j] for j in order]))
+
+    def reorder_tiles(self, order):
+        # Replaces the tiles with the tiles at the given old indices, in order, and
+        # rewrites the map in one pass. Returns the number of tile bytes reclaimed
+        remap = [0] * len(self.tiles)
+        for (new, old) in enumerate(order):
+            remap[old] = new
+        reclaimed = sum(map(len, self.tiles)) - sum([len(self.tiles[old]) for old in order])
+        self.begin_step()
+        self.set_attr('tiles', [self.tiles[old] for old in order])
+        self.set_plane('map', array('H', [remap[value & TILE_INDEX] | (value & TILE_FLIPS) for value in self.map]))
+        self.end_step()
+        return reclaimed
+
+    def remove_unused_tiles(self):
+        # Returns (number of tiles removed, number of tile bytes reclaimed)
+        used_tiles = self.get_tile_uses()
+        if len(used_tiles) == len(self.tiles):
+            return (0, 0)
+        order = [i for i in range(len(self.tiles)) if i in used_tiles]
+        return (len(self.tiles) - len(order), self.reorder_tiles(order))
+
+    def swap_tiles(self, a, b):
+        # Swaps two tiles, rewriting only the cells that use them
+        if a == b:
+            return
+        tiles = list(self.tiles)
+        (tiles[a], tiles[b]) = (tiles[b], tiles[a])
+        indices = array('I', sorted(self.tile_cells(a) + self.tile_cells(b)))
+        values = array('H', [(b if value & TILE_INDEX == a else a) | (value & TILE_FLIPS)
+                             for value in [self.map[i] for i in indices]])
+        self.begin_step()
+        self.set_attr('tiles', tiles)
+        self.set_cells('map', indices, values)
+        self.end_step()
+
+    def get_tile_uses(self):
+        if self.tile_uses is None:
+            self.tile_uses = {}
+            for (i, value) in enumerate(self.map):
+                self.tile_uses.setdefault(value & TILE_INDEX, set()).add(i)
+        return self.tile_uses
+
+    def tile_use_count(self, tile):
+        return len(self.get_tile_uses().get(tile, ()))
+
+    def tile_cells(self, tile):
+        # Returns the indices of the cells using the given tile, in order
+        return sorted(self.get_tile_uses().get(tile, ()))
+
+    def replace_tile(self, tile, new_tile):
+        # Replaces every use of a tile with another, keeping any flips, and returns the
+        # changed cells as rectangles
+        indices = array('I', self.tile_cells(tile))
+        if tile == new_tile or len(indices) == 0:
+            return []
+        values = array('H', [new_tile | (self.map[i] & TILE_FLIPS) for i in indices])
+        return self.set_cells('map', indices, values)
+
+class Ctx(Document):
     def __init__(self):
+        super().__init__()
         self.canvas = None # Main map drawing canvas
-        self.clipboard = None # The last thing copied or cut [ width, height, [tilemap] ]
+        self.clipboard = None # The last thing copied or cut [ width, height, [tilemap], [tags] ]
         self.tiles_canvas = None # Tiles drawing canvas
         self.main_frame = None # Main window frame
         self.property_widgets = [] # List of widgets that require a selection
         self.note_text = None # The Text widget for cell notes
         self.set_cell_tag = None # Callback (tag, desc) to update the cell properties UI
-        self.data_tree = None # Treeview containing cell data (id, data, desc)
+        self.data_tree = None # Treeview showing cell data (id, data, desc)
         self.entity_tree = None # Treeview containing entity list (type, tx, sx, ty, sy, desc)
         self.entity_data_tree = None # Treeview to show individual entity data (data)
         self.status_left = None # Status bar text variable
@@ -60,103 +789,118 @@ class Ctx:
         self.draw_grid = False
         self.draw_tags = True
         self.draw_entities = True
+        self.selection = None # List of top-left and bottom-right tile coordinate lists
+        self.tile_cache = {} # Rendered tile image data, keyed by (tile index, tag)
+        self.tile_cache_palette = None # The palette the tile cache was rendered with
+        self.tint_table = None # RGB data of each palette colour tinted by each tag, indexed [tag][colour]
+        self.dirty = [] # Cell rectangles (x1, y1, x2, y2) awaiting redraw
+        self.chunks = collections.OrderedDict() # Rendered map chunks [image, canvas item or None, bytes] keyed by (zoom, x, y), least recently used first
+        self.chunks_size = 0 # Total bytes of rendered map chunks
+        self.viewport_pending = False # Whether a viewport update is scheduled
+        self.tiles_atlas = None # Rendered visible tile strip [image, canvas item, first column, last column]
+        self.tiles_pending = False # Whether a tile strip update is scheduled
+        self.edit_menu = None # Edit menu
+        self.widget_states = {} # Last state set on each widget or menu entry, keyed by name
+        self.motion_event = None # Latest pointer motion event awaiting handling
+        self.selection_drawn = None # Canvas coordinates the selection rectangle was last drawn at
+        self.status_text = None # Last text shown in the right of the status bar
+        self.uses_tile = None # Tile whose uses are highlighted on the map
 
     def reset(self):
-        self.name = None # Open file name
-        self.tiles = [] # Tile store (in binary CPC pixel format)
-        self.map = [] # Tile map
-        self.tags = [] # Tile tags map
-        self.notes = [] # Map of notes for cells in tile map
-        self.entity_size = 4
-        self.entities = [] # Entity list (Type, Tile X, Scroll X, Tile Y, Scroll Y, desc, [[data, desc]+])
-        self.palette = [] # Palette as hex values
-        self.width = 0 # Map width in tiles
-        self.height = 0 # Map height in tiles
-        self.mode = 0 # CPC screen mode
-        self.tile_width = 8
-        self.tile_height = 8
-        self.selection = None # List of top-left and bottom-right tile coordinate lists
-        self.data_tree.delete(*self.data_tree.get_children())
-        self.entity_tree.delete(*self.entity_tree.get_children())
-        self.entity_data_tree.delete(*self.entity_data_tree.get_children())
+        super().reset()
+        self.selection = None
+        invalidate_tile_cache()
+        refresh_data_tree()
+        refresh_entity_tree()
         self.note_text.delete('1.0', END)
         update_selection()
+        update_undo_menu()
 
-    def load(self, data):
-        obj = json.loads(data, object_hook=lambda d: SimpleNamespace(**d))
-        self.tiles = []
-        for tile in obj.tiles:
-            self.tiles.append(base64.b64decode(tile))
-        self.data_tree.delete(*self.data_tree.get_children())
-        for datum in obj.data:
-            self.data_tree.insert('', END, values=datum)
-        for attr in ['map', 'tags', 'notes', 'entity_size', 'entities',
-                     'palette', 'width', 'height', 'mode',
-                    'tile_width', 'tile_height']:
-            setattr(self, attr, getattr(obj, attr))
-        
-        self.entity_tree.delete(*self.entity_tree.get_children())
-        self.entity_data_tree.delete(*self.entity_data_tree.get_children())
-        for entity in self.entities:
-            self.entity_tree.insert('', END, values=tuple(entity[0:6]))
+    def load(self, data, mapfile=None):
+        super().load(data, mapfile)
+        invalidate_tile_cache()
+        refresh_data_tree()
+        refresh_entity_tree()
 
-    def toJSON(self):
-        return Ctx.__serialiser__(self).toJSON()
+    def journal_changed(self):
+        update_undo_menu()
 
 ctx = Ctx()
 
 
-def get_pixel(tile, x, y):
-    pixel = 0
-    pixels_per_byte = 2 if ctx.mode == 0 else (4 if ctx.mode == 1 else 8)
-    cpc_pixel = tile[(int(ctx.tile_width / pixels_per_byte) * y) + int(x // pixels_per_byte)]
-    # TODO: Verify mode 2 and 1 are correct here
-    if ctx.mode == 2:
-        pixel = (cpc_pixel & (1 << (x % 8))) >> (x % 8)
-    elif ctx.mode == 1:
-        cpc_pixel = cpc_pixel << (x % 4)
-        pixel = ((cpc_pixel & 0b10000000) >> 7) | ((cpc_pixel & 0b00001000) >> 2)
-    elif ctx.mode == 0:
-        cpc_pixel = cpc_pixel << (x % 2)
-        pixel = ((cpc_pixel & 0b10000000) >> 7) | \
-                ((cpc_pixel & 0b00001000) >> 2) | \
-                ((cpc_pixel & 0b00100000) >> 3) | \
-                ((cpc_pixel & 0b00000010) << 2)
-
-    return pixel
-
-def get_byte(row, offset, mode):
-    cpc_pixel = 0
-    if mode == 2:
-        cpc_pixel = (row[offset] << 7) | \
-                    (row[offset+1] << 6) | \
-                    (row[offset+2] << 5) | \
-                    (row[offset+3] << 4) | \
-                    (row[offset+4] << 3) | \
-                    (row[offset+5] << 2) | \
-                    (row[offset+6] << 1) | \
-                    row[offset+7]
-    elif mode == 1:
-        pixel0 = row[offset]
-        pixel1 = row[offset+1]
-        pixel2 = row[offset+2]
-        pixel3 = row[offset+3]
-        cpc_pixel = ((pixel0 & 0b01) << 7) | ((pixel1 & 0b01) << 6) | \
-                    ((pixel2 & 0b01) << 5) | ((pixel3 & 0b01) << 4) | \
-                    ((pixel0 & 0b10) << 2) | ((pixel1 & 0b10) << 1) | \
-                    ((pixel2 & 0b10)) | ((pixel3 & 0b10) >> 1)
-    elif mode == 0:
-        pixel0 = row[offset]
-        pixel1 = row[offset+1]
-        cpc_pixel = (0b10000000 if (pixel0 & 0b0001) != 0 else 0) | \
-                    (0b01000000 if (pixel1 & 0b0001) != 0 else 0) | \
-                    (0b00100000 if (pixel0 & 0b0100) != 0 else 0) | \
-                    (0b00010000 if (pixel1 & 0b0100) != 0 else 0) | \
-                    (0b00001000 if (pixel0 & 0b0010) != 0 else 0) | \
-                    (0b00000100 if (pixel1 & 0b0010) != 0 else 0) | \
-                    (0b00000010 if (pixel0 & 0b1000) != 0 else 0) | \
-                    (0b00000001 if (pixel1 & 0b1000) != 0 else 0)
-    return cpc_pixel
+# Bit positions within a CPC byte for each bit of each pixel, per screen mode
+PIXEL_BITS = [
+    [[7, 3, 5, 1], [6, 2, 4, 0]],
+    [[7, 3], [6, 2], [5, 1], [4, 0]],
+    [[7], [6], [5], [4], [3], [2], [1], [0]],
+]
+
+def build_decode_table(mode):
+    table = []
+    for cpc_pixel in range(256):
+        pixels = []
+        for bits in PIXEL_BITS[mode]:
+            pixel = 0
+            for (bit, position) in enumerate(bits):
+                pixel |= ((cpc_pixel >> position) & 1) << bit
+            pixels.append(pixel)
+        table.append(tuple(pixels))
+    return table
+
+# Tables mapping each CPC byte to its tuple of palette indices, per screen mode
+DECODE_TABLES = [build_decode_table(mode) for mode in range(3)]
+
+def decode_tile_row(tile, y, mode, tile_width):
+    bytes_per_row = tile_width // len(PIXEL_BITS[mode])
+    table = DECODE_TABLES[mode]
+    row = []
+    for cpc_pixel in tile[y * bytes_per_row:(y + 1) * bytes_per_row]:
+        row.extend(table[cpc_pixel])
+    return row
+
+def decode_tile(tile, mode, tile_width):
+    bytes_per_row = tile_width // len(PIXEL_BITS[mode])
+    return [decode_tile_row(tile, y, mode, tile_width)
+            for y in range(len(tile) // bytes_per_row)]
+
+# Tables mapping each pair, quad or octet of palette indices to its CPC byte
+ENCODE_TABLES = [{pixels: cpc_pixel for (cpc_pixel, pixels) in enumerate(table)}
+                 for table in DECODE_TABLES]
+
+# Tables mapping each CPC byte to the byte with its pixels in reverse order
+MIRROR_TABLES = [bytes([ENCODE_TABLES[mode][table[cpc_pixel][::-1]] for cpc_pixel in range(256)])
+                 for (mode, table) in enumerate(DECODE_TABLES)]
+
+TILE_INDEX = 0x3fff # Map value bits holding the tile index
+TILE_HFLIP = 0x8000 # Map value bit for a horizontally mirrored tile
+TILE_VFLIP = 0x4000 # Map value bit for a vertically flipped tile
+TILE_FLIPS = TILE_HFLIP | TILE_VFLIP
+
+def flip_tile(tile, flags, mode, tile_width):
+    bytes_per_row = tile_width // len(PIXEL_BITS[mode])
+    rows = [tile[i:i + bytes_per_row] for i in range(0, len(tile), bytes_per_row)]
+    if flags & TILE_HFLIP:
+        rows = [row[::-1].translate(MIRROR_TABLES[mode]) for row in rows]
+    if flags & TILE_VFLIP:
+        rows.reverse()
+    return b''.join(rows)
+
+def orient_tile(tile, mode, tile_width):
+    # Returns (canonical tile, flags), where flipping the canonical tile by flags gives tile
+    variants = [(flip_tile(tile, flags, mode, tile_width), flags)
+                for flags in (0, TILE_HFLIP, TILE_VFLIP, TILE_FLIPS)]
+    return min(variants)
+
+def encode_scanline(scanline, mode):
+    pixels = [iter(scanline)] * len(PIXEL_BITS[mode])
+    return bytes(map(ENCODE_TABLES[mode].__getitem__, zip(*pixels)))
+
+def encode_band(scanlines, mode, tile_width):
+    # Yields the tiles of a band of tile height scanlines, from left to right
+    encoded = [encode_scanline(scanline, mode) for scanline in scanlines]
+    bytes_per_row = tile_width // len(PIXEL_BITS[mode])
+    for offset in range(0, len(encoded[0]), bytes_per_row):
+        yield b''.join([scanline[offset:offset + bytes_per_row] for scanline in encoded])
 
 def validate_number(S):
     return S.isdecimal()
@@ -181,13 +925,12 @@ def adjust_zoom(delta, force=False):
     xview = ctx.canvas.xview()
     yview = ctx.canvas.yview()
 
-    width_scale = 2 if ctx.mode == 0 else 1
-    height_scale = 2 if ctx.mode == 2 else 1
-    img = ctx.canvas.image.zoom(width_scale * ctx.zoom, height_scale * ctx.zoom)
-    ctx.canvas.config(scrollregion=(0, 0, img.width(), img.height()))
-    ctx.canvas.delete('image')
-    ctx.canvas.create_image((img.width()/2, img.height()/2), image=img, tags='image')
-    ctx.canvas.zoomed_image = img
+    width_scale = (2 if ctx.mode == 0 else 1) * ctx.zoom
+    height_scale = (2 if ctx.mode == 2 else 1) * ctx.zoom
+    if new_zoom != old_zoom:
+        hide_chunks()
+    ctx.canvas.config(scrollregion=(0, 0, ctx.width * ctx.tile_width * width_scale,
+                                    ctx.height * ctx.tile_height * height_scale))
 
     # Reset the scroll position after zoom change
     view_scale = old_zoom / new_zoom
@@ -195,9 +938,12 @@ def adjust_zoom(delta, force=False):
     newyview = max(0, yview[0] + ((yview[1] - yview[0]) / 2 * (1.0 - view_scale)))
     ctx.canvas.xview_moveto(newxview)
     ctx.canvas.yview_moveto(newyview)
+    update_viewport()
 
     redraw_grid()
     redraw_entities()
+    redraw_uses()
+    ctx.selection_drawn = None # Lift the selection above the new grid and entities
     update_selection()
 
 def tile_coords_from_coords(e):
@@ -227,56 +973,79 @@ def copy(root, cut=False):
     y1 = min(ctx.selection[0][1], ctx.selection[1][1])
     y2 = max(ctx.selection[0][1], ctx.selection[1][1]) + 1
 
-    ctx.clipboard = [x2 - x1, y2 - y1, [], []]
-    for x in range(x1, x2):
-        for y in range(y1, y2):
-            i = x * ctx.height + y
-            ctx.clipboard[2].append(ctx.map[i])
-            ctx.clipboard[3].append(ctx.tags[i])
-            if cut:
-                ctx.map[i] = 0
-                ctx.tags[i] = 0
+    ctx.clipboard = ctx.copy(x1, y1, x2, y2, cut)
     if cut:
-        redraw_map()
+        mark_dirty(x1, y1, x2, y2)
+        redraw_dirty()
+        redraw_uses()
 
 def paste(root, ):
-    if ctx.selection is None or ctx.selection[0] != ctx.selection[1] or entry_has_focus(root):
+    if ctx.selection is None or ctx.selection[0] != ctx.selection[1] or \
+       ctx.clipboard is None or entry_has_focus(root):
         return
-    for x in range(0, ctx.clipboard[0]):
-        for y in range(0, ctx.clipboard[1]):
-            if x + ctx.selection[0][0] >= ctx.width or y + ctx.selection[0][1] >= ctx.height:
-                continue
-            i = x * ctx.clipboard[1] + y
-            mi = (ctx.selection[0][0] + x) * ctx.height + (ctx.selection[0][1] + y)
-            ctx.map[mi] = ctx.clipboard[2][i]
-            ctx.tags[mi] = ctx.clipboard[3][i]
-    redraw_map()
+    mark_dirty(*ctx.paste(ctx.clipboard, ctx.selection[0][0], ctx.selection[0][1]))
+    redraw_dirty()
+    redraw_uses()
 
-def update_selection():
-    editmenu = ctx.menu.nametowidget(ctx.menu.entrycget('Edit', 'menu'))
+def undo(root, redo=False):
+    if entry_has_focus(root):
+        return
+
+    (rects, changed) = ctx.undo(redo)
+    if 'tiles' in changed or 'palette' in changed:
+        invalidate_tile_cache()
+        redraw_tiles()
+        update_status()
+    if 'palette' in changed or 'map' in changed:
+        redraw_map()
+    elif len(rects) > 0:
+        for rect in rects:
+            mark_dirty(*rect)
+        redraw_dirty()
+        redraw_uses()
+    if 'entities' in changed:
+        refresh_entity_tree()
+        redraw_entities()
+    if 'data' in changed:
+        refresh_data_tree()
+    if ctx.selection is not None:
+        update_selection()
+
+def set_widget_state(widget, state):
+    # Only touches the widget when its state actually changes
+    if ctx.widget_states.get(str(widget)) != state:
+        ctx.widget_states[str(widget)] = state
+        widget.config(state=state)
 
+def set_menu_state(label, state):
+    # Only touches the Edit menu entry when its state actually changes
+    if ctx.widget_states.get(label) != state:
+        ctx.widget_states[label] = state
+        ctx.edit_menu.entryconfig(label, state=state)
+
+def update_undo_menu():
+    set_menu_state('Undo', NORMAL if len(ctx.undo_steps) > 0 else DISABLED)
+    set_menu_state('Redo', NORMAL if len(ctx.redo_steps) > 0 else DISABLED)
+
+def update_selection():
     if ctx.selection is None:
         for widget in ctx.property_widgets:
-            widget.config(state=DISABLED)
-        ctx.note_text.config(state=DISABLED)
+            set_widget_state(widget, DISABLED)
+        set_widget_state(ctx.note_text, DISABLED)
         ctx.canvas.delete('selection')
-        editmenu.entryconfig('Cut', state='disabled')
-        editmenu.entryconfig('Copy', state='disabled')
-        editmenu.entryconfig('Paste', state='disabled')
+        ctx.selection_drawn = None
+        set_menu_state('Cut', DISABLED)
+        set_menu_state('Copy', DISABLED)
+        set_menu_state('Paste', DISABLED)
         return
 
-    editmenu.entryconfig('Cut', state='normal')
-    editmenu.entryconfig('Copy', state='normal')
-
-    if ctx.selection[0] == ctx.selection[1]:
-        if ctx.clipboard is not None:
-            editmenu.entryconfig('Paste', state='normal')
-        ctx.note_text.config(state=NORMAL)
-    else:
-        editmenu.entryconfig('Paste', state='disabled')
-        ctx.note_text.config(state=DISABLED)
+    single = ctx.selection[0] == ctx.selection[1]
+    set_menu_state('Cut', NORMAL)
+    set_menu_state('Copy', NORMAL)
+    set_menu_state('Paste', NORMAL if single and ctx.clipboard is not None else DISABLED)
+    set_widget_state(ctx.note_text, NORMAL if single else DISABLED)
     for widget in ctx.property_widgets:
-        widget.config(state=NORMAL)
+        set_widget_state(widget, NORMAL)
 
     # Work out selection coordinates
     x1 = min(ctx.selection[0][0], ctx.selection[1][0])
@@ -295,14 +1064,15 @@ def update_selection():
     rect = ctx.canvas.find_withtag('selection')
     if len(rect) == 0:
         ctx.canvas.create_rectangle((x1, y1, x2, y2), tags=['selection'], width=max(2, ctx.zoom))
-    else:
+    elif ctx.selection_drawn != (x1, y1, x2, y2):
         ctx.canvas.itemconfig(rect[0], width=max(2, ctx.zoom))
         ctx.canvas.coords(rect[0], x1, y1, x2, y2)
         ctx.canvas.lift(rect[0])
+    ctx.selection_drawn = (x1, y1, x2, y2)
 
     # Update cell tag
     if ctx.selection[0] == ctx.selection[1]:
-        ctx.set_cell_tag(ctx.tags[i], ctx.notes[i])
+        ctx.set_cell_tag(ctx.tags[i], ctx.notes.get(i, ''))
 
 def map_coords_from_event(e):
     x = ctx.canvas.canvasx(e.x)
@@ -319,34 +1089,47 @@ def entity_coords_from_event(e):
     sy = y % ctx.tile_height
     return (tx, sx, ty, sy)
 
-def entity_at_point(x, y):
-    tx = int(x / ctx.tile_width)
-    ty = int(y / ctx.tile_height)
-    for i in range(len(ctx.entities)):
-        if tx == ctx.entities[i][1] and \
-           ty == ctx.entities[i][3]:
-            return i
-    return -1
+def entities_at_point(x, y):
+    return ctx.entities_at(int(x / ctx.tile_width), int(y / ctx.tile_height))
+
+def select_entities(indices):
+    children = ctx.entity_tree.get_children()
+    ctx.entity_tree.selection_set([children[i] for i in indices])
 
 def canvas_motion(e):
-    if e.state & 0x0100: # Button1 mask (FIXME: this must be defined somewhere?)
+    # Motion events are coalesced, with only the latest handled once Tk is idle
+    if ctx.motion_event is None:
+        ctx.canvas.after_idle(handle_motion)
+    ctx.motion_event = e
+
+def handle_motion():
+    e = ctx.motion_event
+    if e is None:
+        return
+    ctx.motion_event = None
+
+    if e.state & 0x0100 and ctx.selection is not None: # Button1 mask (FIXME: this must be defined somewhere?)
         i = tile_coords_from_coords(e)
-        if i is not None:
+        if i is not None and i != ctx.selection[1]:
             ctx.selection[1] = i
             update_selection()
     
     (x, y) = map_coords_from_event(e)
-    i = entity_at_point(x, y)
+    entities = entities_at_point(x, y)
     tx = x // ctx.tile_width
     sx = x % ctx.tile_width
     ty = y // ctx.tile_height
     sy = y % ctx.tile_height
-    if i == -1:
-        ctx.status_right.set('(%d-%d, %d-%d)' % (tx, sx, ty, sy))
+    if len(entities) == 0:
+        text = '(%d-%d, %d-%d)' % (tx, sx, ty, sy)
     else:
-        ctx.status_right.set('%s (%d-%d, %d-%d)' % (ctx.entities[i][5], tx, sx, ty, sy))
+        text = '%s (%d-%d, %d-%d)' % (', '.join([ctx.entities[i][5] for i in entities]), tx, sx, ty, sy)
+    if text != ctx.status_text:
+        ctx.status_text = text
+        ctx.status_right.set(text)
 
 def canvas_release(e):
+    handle_motion()
     i = tile_coords_from_coords(e)
     if i is not None:
         ctx.selection[1] = i
@@ -364,14 +1147,21 @@ def canvas_release(e):
         ctx.selection[0][1] = y1
         ctx.selection[1][1] = y2
 
+        # Select the entities in a multi-cell selection
+        if x1 != x2 or y1 != y2:
+            entities = ctx.entities_in(x1, y1, x2 + 1, y2 + 1)
+            if len(entities) > 0:
+                select_entities(entities)
+
 def canvas_press(e):
+    handle_motion()
     ctx.canvas.focus_set()
 
-    # If we've clicked an entity, select it (should we disable selection when this happens?)
+    # If we've clicked entities, select them (should we disable selection when this happens?)
     (x, y) = map_coords_from_event(e)
-    i = entity_at_point(x, y)
-    if i != -1:
-        ctx.entity_tree.selection_set(ctx.entity_tree.get_children()[i])
+    entities = entities_at_point(x, y)
+    if len(entities) > 0:
+        select_entities(entities)
 
     if ctx.map is None:
         return
@@ -385,14 +1175,18 @@ def canvas_press(e):
     ctx.selection = [i, i]
     update_selection()
 
+    if ctx.uses_tile is not None:
+        ctx.uses_tile = None
+        redraw_uses()
+
 def canvas_alt_press(e, root):
     (x, y) = map_coords_from_event(e)
-    i = entity_at_point(x, y)
-    if i == -1:
+    entities = entities_at_point(x, y)
+    if len(entities) == 0:
         (tx, sx, ty, sy) = entity_coords_from_event(e)
         add_entity(root, [0, tx, sx, ty, sy, ''])
     else:
-        ctx.entity_tree.selection_set(ctx.entity_tree.get_children()[i])
+        select_entities(entities)
         edit_entity(root)
 
 def canvas_mousewheel(e):
@@ -441,61 +1235,74 @@ def canvas_scroll(root, x, y):
     elif y > 0 and yview[1] < 1.0:
         ctx.canvas.yview_moveto(min(1.0 - (yview[1] - yview[0]), yview[0] + 1.0/ctx.height))
 
+def canvas_scrolled(scrollbar, first, last):
+    scrollbar.set(first, last)
+    schedule_viewport_update()
+
+def tiles_scrolled(scrollbar, first, last):
+    scrollbar.set(first, last)
+    schedule_tiles_update()
+
 def tiles_canvas_clicked(e):
     if ctx.selection is None:
         return
-    
-    target = ctx.tiles_canvas.find_overlapping(ctx.tiles_canvas.canvasx(e.x),
-                                               ctx.tiles_canvas.canvasy(e.y),
-                                               ctx.tiles_canvas.canvasx(e.x),
-                                               ctx.tiles_canvas.canvasy(e.y))
-    if len(target) != 1:
+
+    tile = tile_at(e.x, e.y)
+    if tile is None:
         return
-    
-    tile = int(ctx.tiles_canvas.gettags(target[0])[0])
-    for y in range(ctx.selection[0][1], ctx.selection[1][1]+1):
-        for x in range(ctx.selection[0][0], ctx.selection[1][0]+1):
-            ctx.map[x * ctx.height + y] = tile
-            draw_map_tile(x, y)
-    adjust_zoom(0, True)
 
-def tiles_canvas_alt_clicked(e):
-    target = ctx.tiles_canvas.find_overlapping(ctx.tiles_canvas.canvasx(e.x),
-                                               ctx.tiles_canvas.canvasy(e.y),
-                                               ctx.tiles_canvas.canvasx(e.x),
-                                               ctx.tiles_canvas.canvasy(e.y))
-    if len(target) != 1:
+    rect = (ctx.selection[0][0], ctx.selection[0][1], ctx.selection[1][0] + 1, ctx.selection[1][1] + 1)
+    ctx.fill(*rect, tile)
+    mark_dirty(*rect)
+    redraw_dirty()
+    redraw_uses()
+
+def tiles_canvas_shift_clicked(e):
+    # Replace every use of the selected cell's tile with the clicked tile
+    tile = tile_at(e.x, e.y)
+    if tile is None or ctx.selection is None:
         return
-    
-    idx = int(ctx.tiles_canvas.gettags(target[0])[0])
-    if idx == 0:
+
+    (x, y) = ctx.selection[0]
+    for rect in ctx.replace_tile(ctx.map[x * ctx.height + y] & TILE_INDEX, tile):
+        mark_dirty(*rect)
+    redraw_dirty()
+    redraw_uses()
+
+def tiles_canvas_control_clicked(e):
+    tile = tile_at(e.x, e.y)
+    if tile is not None:
+        show_tile_uses(tile)
+
+def tile_info(tile):
+    text = 'Tile %d: used %d times' % (tile, ctx.tile_use_count(tile))
+    tags = sorted(ctx.get_tile_tags().get(tile, {}))
+    if len(tags) > 1:
+        text += ', conflicting tags %s' % ', '.join(map(str, tags))
+    return text
+
+def tiles_canvas_motion(e):
+    tile = tile_at(e.x, e.y)
+    text = '' if tile is None else tile_info(tile)
+    if text != ctx.status_text:
+        ctx.status_text = text
+        ctx.status_right.set(text)
+
+def tiles_canvas_alt_clicked(e):
+    idx = tile_at(e.x, e.y)
+    if idx is None or idx == 0:
         return
-    
-    old_tile = ctx.tiles[0]
-    ctx.tiles[0] = ctx.tiles[idx]
-    ctx.tiles[idx] = old_tile
-    
-    for i in range(0, ctx.width * ctx.height):
-        if ctx.map[i] == 0:
-            ctx.map[i] = idx
-        elif ctx.map[i] == idx:
-            ctx.map[i] = 0
 
-    redraw_tiles()
+    ctx.swap_tiles(0, idx)
+    invalidate_tile_cache()
+    update_tiles([0, idx])
 
 def store_cell_tag(number):
     if ctx.selection is not None:
-        changed = False
-        for y in range(ctx.selection[0][1], ctx.selection[1][1] + 1):
-            for x in range(ctx.selection[0][0], ctx.selection[1][0] + 1):
-                i = x * ctx.height + y
-                if ctx.tags[i] != number:
-                    changed = True
-                    ctx.tags[i] = number
-                    if ctx.draw_tags:
-                        draw_map_tile(x, y)
-        if changed and ctx.draw_tags:
-            adjust_zoom(0, True)
+        rect = (ctx.selection[0][0], ctx.selection[0][1], ctx.selection[1][0] + 1, ctx.selection[1][1] + 1)
+        if ctx.set_tags(*rect, number) and ctx.draw_tags:
+            mark_dirty(*rect)
+            redraw_dirty()
 
 def update_hex(number, hex_text):
     hex_text[0].set('%x' % (number >> 4))
@@ -526,9 +1333,9 @@ def note_modified():
     ctx.note_text.edit_modified(False)
     if ctx.selection is None:
         return
-    for y in range(ctx.selection[0][1], ctx.selection[1][1]+1):
-        for x in range(ctx.selection[0][0], ctx.selection[1][0]+1):
-            ctx.notes[x * ctx.height + y] = ctx.note_text.get('1.0', END).rstrip()
+    ctx.set_notes(ctx.selection[0][0], ctx.selection[0][1],
+                  ctx.selection[1][0] + 1, ctx.selection[1][1] + 1,
+                  ctx.note_text.get('1.0', END).rstrip())
 
 def update_cell_tag(number, desc, tag_entry):
     ctx.note_text.unbind('<<Modified>>')
@@ -541,78 +1348,37 @@ def update_cell_tag(number, desc, tag_entry):
 def apply_cell_tag_to_similar():
     if ctx.selection is None:
         return
-    changed = False
-    for y in range(0, ctx.height):
-        for x in range(0, ctx.width):
-            # Don't check inside the selection
-            if x >= min(ctx.selection[0][0], ctx.selection[1][0]) and \
-               x <= max(ctx.selection[0][0], ctx.selection[1][0]) and \
-               y >= min(ctx.selection[0][1], ctx.selection[1][1]) and \
-               y <= max(ctx.selection[0][1], ctx.selection[1][1]):
-                continue
-
-            # Check if this bit of the map matches the selection
-            same = True
-            for sy in range(ctx.selection[0][1], ctx.selection[1][1]+1):
-                for sx in range(ctx.selection[0][0], ctx.selection[1][0]+1):
-                    mx = x + (sx - ctx.selection[0][0])
-                    my = y + (sy - ctx.selection[0][1])
-                    i = mx * ctx.height + my
-                    si = sx * ctx.height + sy
-                    if ctx.map[i] != ctx.map[si]:
-                        same = False
-                        break
-                if not same:
-                    break
-            if not same:
-                continue
-
-            # Update the tags and redraw that part of the map
-            for sy in range(ctx.selection[0][1], ctx.selection[1][1]+1):
-                for sx in range(ctx.selection[0][0], ctx.selection[1][0]+1):
-                    mx = x + (sx - ctx.selection[0][0])
-                    my = y + (sy - ctx.selection[0][1])
-                    i = mx * ctx.height + my
-                    si = sx * ctx.height + sy
-                    ctx.tags[i] = ctx.tags[si]
-                    draw_map_tile(mx, my)
-                    changed = True
-    if changed:
-        adjust_zoom(0, True)
-
-
-def get_unique_cell_tags():
-    unique_tags = {}
-    for y in range(0, ctx.height):
-        for x in range(0, ctx.width):
-            i = x * ctx.height + y
-            tile = ctx.map[i]
-            if tile not in unique_tags or unique_tags[tile] == 0:
-                unique_tags[tile] = ctx.tags[i]
-    return unique_tags
+    changed = ctx.apply_tags_to_similar(ctx.selection[0][0], ctx.selection[0][1],
+                                        ctx.selection[1][0] + 1, ctx.selection[1][1] + 1)
+    if ctx.draw_tags:
+        for rect in changed:
+            mark_dirty(*rect)
+        redraw_dirty()
 
 
 def dedupe_cell_tags():
-    unique_tags = get_unique_cell_tags()
-    for y in range(0, ctx.height):
-        for x in range(0, ctx.width):
-            i = x * ctx.height + y
-            ctx.tags[i] = unique_tags[ctx.map[i]]
+    conflicts = ctx.get_tag_conflicts()
+    if len(conflicts) > 0:
+        tiles = ', '.join(map(str, conflicts[:16])) + (', ...' if len(conflicts) > 16 else '')
+        if not messagebox.askokcancel('De-dupe cell tags', 'Tiles %s have conflicting tags. '
+                                      'The first tag used for each will be kept.' % tiles):
+            return
+    changed = ctx.dedupe_cell_tags()
     if ctx.draw_tags:
-        redraw_map()
+        for rect in changed:
+            mark_dirty(*rect)
+        redraw_dirty()
 
 
 def remove_unused_tiles():
-    used_tiles = set(ctx.map)
-    for i in reversed(range(len(ctx.tiles))):
-        if i in used_tiles:
-            continue
-        del ctx.tiles[i]
-        for j in range(len(ctx.map)):
-            if ctx.map[j] > i:
-                ctx.map[j] -= 1
+    (removed, reclaimed) = ctx.remove_unused_tiles()
+    if removed == 0:
+        messagebox.showinfo('Remove unused tiles', 'No unused tiles to remove')
+        return
+    invalidate_tile_cache()
     redraw_tiles()
     update_status()
+    messagebox.showinfo('Remove unused tiles', 'Removed %d tiles (%d bytes)' % (removed, reclaimed))
 
 
 def edit_entity_data(root):
@@ -621,14 +1387,17 @@ def edit_entity_data(root):
         return
     i = ctx.entity_tree.index(selection[0])
 
+    ctx.begin_step()
     for item in ctx.entity_data_tree.selection():
         j = ctx.entity_data_tree.index(item)
         d = EntityDataDialog(root, ctx.entities[i][6][j]).result
         if d is None:
             continue
-        ctx.entities[i][6][j][0] = d['data']
-        ctx.entities[i][6][j][1] = d['desc']
+        entity = deepcopy(ctx.entities[i])
+        entity[6][j] = [d['data'], d['desc']]
+        ctx.set_row('entities', i, entity)
         ctx.entity_data_tree.item(item, values=ctx.entities[i][6][j])
+    ctx.end_step()
 
 class EntityDataDialog(simpledialog.Dialog):
     def __init__(self, parent, data):
@@ -679,22 +1448,26 @@ class EntityDataDialog(simpledialog.Dialog):
 
 def edit_entity(root):
     changed = False
+    ctx.begin_step()
     for item in ctx.entity_tree.selection():
         i = ctx.entity_tree.index(item)
         d = EntityDialog(root, 'Edit entity', ctx.entities[i]).result
         if d is None:
             continue
-        ctx.entities[i][0] = d['type']
-        ctx.entities[i][1] = d['tx']
-        ctx.entities[i][2] = d['sx']
-        ctx.entities[i][3] = d['ty']
-        ctx.entities[i][4] = d['sy']
-        ctx.entities[i][5] = d['desc']
+        ctx.set_row('entities', i, [d['type'], d['tx'], d['sx'], d['ty'], d['sy'], d['desc'],
+                                    deepcopy(ctx.entities[i][6])])
         ctx.entity_tree.item(item, values=ctx.entities[i][0:6])
         changed = True
+    ctx.end_step()
     if changed:
         redraw_entities()
 
+def refresh_entity_tree():
+    ctx.entity_tree.delete(*ctx.entity_tree.get_children())
+    ctx.entity_data_tree.delete(*ctx.entity_data_tree.get_children())
+    for entity in ctx.entities:
+        ctx.entity_tree.insert('', END, values=tuple(entity[0:6]))
+
 def select_entity():
     selection = ctx.entity_tree.selection()
     if len(selection) < 1:
@@ -706,18 +1479,23 @@ def select_entity():
         ctx.entity_data_tree.insert('', END, values=datum)
 
 def reorder_entity(direction):
+    order = list(range(len(ctx.entities)))
     for item in ctx.entity_tree.selection():
         i = ctx.entity_tree.index(item)
         if i + direction < 0 or i + direction >= len(ctx.entities):
             continue
         ctx.entity_tree.move(item, "", ctx.entity_tree.index(item) + direction)
-        ctx.entities[i], ctx.entities[i+direction] = ctx.entities[i+direction], ctx.entities[i]
+        order[i], order[i+direction] = order[i+direction], order[i]
+    if order != sorted(order):
+        ctx.reorder_rows('entities', order)
 
 def remove_entity():
+    ctx.begin_step()
     for item in ctx.entity_tree.selection():
         i = ctx.entity_tree.index(item)
-        del ctx.entities[i]
+        ctx.set_row('entities', i, None)
         ctx.entity_tree.delete(item)
+    ctx.end_step()
     ctx.entity_data_tree.delete(*ctx.entity_data_tree.get_children())
     redraw_entities()
 
@@ -740,7 +1518,7 @@ def add_entity(root, defaults=None):
     if len(ctx.entities) > 0:
         for x in range(ctx.entity_size):
             entity[6][x][1] = ctx.entities[-1][6][x][1]
-    ctx.entities.append(entity)
+    ctx.insert_row('entities', len(ctx.entities), entity)
     ctx.entity_tree.insert('', END, values=entity[0:6])
     redraw_entities()
 
@@ -839,9 +1617,17 @@ class EntityDialog(simpledialog.Dialog):
         self.result = None
         self.destroy()
 
+def refresh_data_tree():
+    ctx.data_tree.delete(*ctx.data_tree.get_children())
+    for datum in ctx.data:
+        ctx.data_tree.insert('', END, values=tuple(datum))
+
 def remove_data():
-    for item in ctx.data_tree.selection():
-        ctx.data_tree.delete(item)
+    ctx.begin_step()
+    for i in sorted([ctx.data_tree.index(item) for item in ctx.data_tree.selection()], reverse=True):
+        ctx.set_row('data', i, None)
+    ctx.end_step()
+    refresh_data_tree()
 
 def validate_data(data):
     if data['id'] < 0 or data['id'] > 255:
@@ -860,28 +1646,31 @@ def add_data(root):
     if d.result is None:
         return
     
-    ctx.data_tree.insert('', END, values=(d.result['id'], d.result['data'], d.result['desc']))
+    ctx.insert_row('data', len(ctx.data), [d.result['id'], d.result['data'], d.result['desc']])
+    ctx.data_tree.insert('', END, values=tuple(ctx.data[-1]))
 
 def edit_data(root):
-    for i in ctx.data_tree.selection():
-        d = MetadataDialog(root, 'Edit data', ctx.data_tree.item(i)['values'])
+    ctx.begin_step()
+    for item in ctx.data_tree.selection():
+        i = ctx.data_tree.index(item)
+        d = MetadataDialog(root, 'Edit data', ctx.data[i])
         if d.result is None:
             continue
-        ctx.data_tree.item(i, values=(d.result['id'], d.result['data'], d.result['desc']))
+        ctx.set_row('data', i, [d.result['id'], d.result['data'], d.result['desc']])
+        ctx.data_tree.item(item, values=tuple(ctx.data[i]))
+    ctx.end_step()
 
 def data_sort_key(a):
-    if a[0].isdecimal():
-        return int(a[0])
-    return a[0]
+    if a.isdecimal():
+        return int(a)
+    return a
 
 def data_sort(col, reverse):
-    items = [(ctx.data_tree.set(i, col), i) for i in ctx.data_tree.get_children('')]
-    items.sort(key=data_sort_key, reverse=reverse)
+    column = ['id', 'data', 'desc'].index(col)
+    ctx.reorder_rows('data', sorted(range(len(ctx.data)), key=lambda i: data_sort_key(str(ctx.data[i][column])),
+                                    reverse=reverse))
+    refresh_data_tree()
 
-    for index, (val, i) in enumerate(items):
-        ctx.data_tree.move(i, '', index)
-    
-    heading = ctx.data_tree.heading(col)
     ctx.data_tree.heading(col, command=lambda col=col: data_sort(col, not reverse))
 
 class MetadataDialog(simpledialog.Dialog):
@@ -1034,36 +1823,15 @@ class PropertiesDialog(simpledialog.Dialog):
             if new_width == 0 or new_height == 0:
                 ctx.reset()
             else:
-                new_map = [0 for x in range(new_width * new_height)]
-                new_tags = [0 for x in range(new_width * new_height)]
-                new_notes = ['' for x in range(new_width * new_height)]
-                for y in range(0, min(ctx.height, new_height)):
-                    for x in range(0, min(ctx.width, new_width)):
-                        i = x * ctx.height + y
-                        i2 = x * new_height + y
-                        new_map[i2] = ctx.map[i]
-                        new_tags[i2] = ctx.tags[i]
-                        new_notes[i2] = ctx.notes[i]
-                ctx.map = new_map if len(ctx.tiles) > 0 else []
-                ctx.tags = new_tags
-                ctx.notes = new_notes
+                ctx.resize(new_width, new_height)
                 ctx.selection = None
                 update_selection()
             ctx.width = new_width
             ctx.height = new_height
 
         if new_size != ctx.entity_size:
-            for entity in ctx.entities:
-                if new_size < ctx.entity_size:
-                    entity[6] = entity[6][:new_size]
-                else:
-                    entity[6] = entity[6] + [[0, ''] for x in range(new_size - ctx.entity_size)]
-            ctx.entity_size = new_size
-
-            ctx.entity_tree.delete(*ctx.entity_tree.get_children())
-            ctx.entity_data_tree.delete(*ctx.entity_data_tree.get_children())
-            for entity in ctx.entities:
-                ctx.entity_tree.insert('', END, values=tuple(entity[0:6]))
+            ctx.set_entity_size(new_size)
+            refresh_entity_tree()
 
         refresh_ui()
         self.destroy()
@@ -1088,6 +1856,33 @@ def redraw_entities():
     for entity in ctx.entities:
         draw_entity(entity)
 
+def redraw_uses():
+    ctx.canvas.delete('uses')
+    if ctx.uses_tile is None:
+        return
+
+    width_scale = (2 if ctx.mode == 0 else 1) * ctx.zoom
+    height_scale = (2 if ctx.mode == 2 else 1) * ctx.zoom
+    for (x1, y1, x2, y2) in cell_runs(ctx.tile_cells(ctx.uses_tile), ctx.height):
+        ctx.canvas.create_rectangle((x1 * ctx.tile_width * width_scale, y1 * ctx.tile_height * height_scale,
+                                     x2 * ctx.tile_width * width_scale, y2 * ctx.tile_height * height_scale),
+                                    outline='yellow', width=max(2, ctx.zoom), tags='uses')
+
+def show_tile_uses(tile=None):
+    # Highlight every use of the given tile, or of the tile in the selected cell
+    if len(ctx.tiles) == 0:
+        return
+    if tile is None:
+        if ctx.selection is None:
+            return
+        (x, y) = ctx.selection[0]
+        tile = ctx.map[x * ctx.height + y] & TILE_INDEX
+    ctx.uses_tile = tile
+    redraw_uses()
+
+    ctx.status_text = tile_info(tile)
+    ctx.status_right.set(ctx.status_text)
+
 def redraw_grid():
     ctx.canvas.delete('grid')
     if not ctx.draw_grid:
@@ -1103,87 +1898,315 @@ def redraw_grid():
         ctx.canvas.create_line(x * width_scale, 0, x * width_scale, ctx.height * ctx.tile_height * height_scale,
                                dash=dash, tags='grid')
 
-def draw_tile(tile, image, ox, oy):
-    for y in range(0, ctx.tile_height):
-        for x in range(0, ctx.tile_width):
-            image.put(ctx.palette[get_pixel(tile, x, y)], (ox + x, oy + y))
+def parse_colour(colour):
+    return (int(colour[1:3], 16), int(colour[3:5], 16), int(colour[5:7], 16))
 
 def mix_colours(c1, c2, weight=0.5):
-    r = int((int(c1[1:3], 16) * weight + int(c2[1:3], 16) * (1 - weight)))
-    g = int((int(c1[3:5], 16) * weight + int(c2[3:5], 16) * (1 - weight)))
-    b = int((int(c1[5:7], 16) * weight + int(c2[5:7], 16) * (1 - weight)))
-    return '#%02x%02x%02x' % (r, g, b)
-
-def draw_map_tile(x, y):
-    i = x * ctx.height + y
-    ox = x * ctx.tile_width
-    oy = y * ctx.tile_height
-    mix = ''
-
-    if ctx.draw_tags and ctx.tags[i] != 0:
-        ci1 = math.floor(ctx.tags[i] / 255.0 * (len(TAG_PALETTE)-1))
-        ci2 = math.ceil(ctx.tags[i] / 255.0 * (len(TAG_PALETTE)-1))
-        c1 = TAG_PALETTE[ci1]
-        c2 = TAG_PALETTE[ci2]
-        weight = 1.0 - ((ctx.tags[i] / 255.0) - int(ctx.tags[i] / 255.0))
-        mix = mix_colours(c1, c2, weight)
-
-    for y in range(0, ctx.tile_height):
-        for x in range(0, ctx.tile_width):
-            c = ctx.palette[get_pixel(ctx.tiles[ctx.map[i]], x, y)]
-            if ctx.draw_tags and ctx.tags[i] != 0:
-                c = mix_colours(c, mix, 0.3)
-            ctx.canvas.image.put(c, (ox + x, oy + y))
+    return tuple(int(a * weight + b * (1 - weight)) for (a, b) in zip(c1, c2))
+
+def build_tint_table(palette):
+    # Returns the RGB data of each palette colour as tinted by each tag, indexed [tag][colour]
+    colours = [parse_colour(c) for c in palette]
+    tag_colours = [parse_colour(c) for c in TAG_PALETTE]
+    table = [[bytes(c) for c in colours]]
+    for tag in range(1, 256):
+        ci1 = math.floor(tag / 255.0 * (len(TAG_PALETTE)-1))
+        ci2 = math.ceil(tag / 255.0 * (len(TAG_PALETTE)-1))
+        weight = 1.0 - ((tag / 255.0) - int(tag / 255.0))
+        mix = mix_colours(tag_colours[ci1], tag_colours[ci2], weight)
+        table.append([bytes(mix_colours(c, mix, 0.3)) for c in colours])
+    return table
+
+def invalidate_tile_cache():
+    ctx.tile_cache = {}
+    if ctx.tile_cache_palette != ctx.palette:
+        ctx.tile_cache_palette = list(ctx.palette)
+        ctx.tint_table = build_tint_table(ctx.palette)
+
+def get_tile_rows(index, tag=0):
+    if ctx.tile_cache_palette != ctx.palette:
+        invalidate_tile_cache()
+
+    key = (index, tag)
+    rows = ctx.tile_cache.get(key)
+    if rows is not None:
+        return rows
+
+    colours = ctx.tint_table[tag]
+
+    # Store as a list of rows of raw RGB data
+    rows = [b''.join([colours[pixel] for pixel in row])
+            for row in decode_tile(ctx.get_tile(index), ctx.mode, ctx.tile_width)]
+    ctx.tile_cache[key] = rows
+    return rows
+
+def ppm_data(width, height, pixels):
+    return b'P6\n%d %d\n255\n' % (width, height) + pixels
+
+def render_map(x1, y1, x2, y2):
+    # Render the given cell rectangle (exclusive) to binary PPM data
+    pixels = bytearray()
+    for y in range(y1, y2):
+        tiles = []
+        for x in range(x1, x2):
+            i = x * ctx.height + y
+            tiles.append(get_tile_rows(ctx.map[i], ctx.tags[i] if ctx.draw_tags else 0))
+        for tiley in range(ctx.tile_height):
+            pixels += b''.join([rows[tiley] for rows in tiles])
+    return ppm_data((x2 - x1) * ctx.tile_width, (y2 - y1) * ctx.tile_height, pixels)
+
+def mark_dirty(x1, y1, x2, y2):
+    ctx.dirty.append((x1, y1, x2, y2))
+
+def get_chunk_size(zoom=None):
+    # Returns the size of a map chunk in cells, at the given or current zoom
+    zoom = ctx.zoom if zoom is None else zoom
+    width_scale = (2 if ctx.mode == 0 else 1) * zoom
+    height_scale = (2 if ctx.mode == 2 else 1) * zoom
+    return (max(1, CHUNK_PIXELS // (ctx.tile_width * width_scale)),
+            max(1, CHUNK_PIXELS // (ctx.tile_height * height_scale)))
+
+def render_chunk(cx, cy):
+    width_scale = (2 if ctx.mode == 0 else 1) * ctx.zoom
+    height_scale = (2 if ctx.mode == 2 else 1) * ctx.zoom
+    (chunk_width, chunk_height) = get_chunk_size()
+    x1 = cx * chunk_width
+    y1 = cy * chunk_height
+    x2 = min(ctx.width, x1 + chunk_width)
+    y2 = min(ctx.height, y1 + chunk_height)
+
+    img = PhotoImage(data=render_map(x1, y1, x2, y2), format='PPM')
+    if width_scale != 1 or height_scale != 1:
+        img = img.zoom(width_scale, height_scale)
+    return [img, None, img.width() * img.height() * 4]
 
-def redraw_map():
+def show_chunk(cx, cy, chunk):
+    width_scale = (2 if ctx.mode == 0 else 1) * ctx.zoom
+    height_scale = (2 if ctx.mode == 2 else 1) * ctx.zoom
+    (chunk_width, chunk_height) = get_chunk_size()
+    chunk[1] = ctx.canvas.create_image((cx * chunk_width * ctx.tile_width * width_scale,
+                                        cy * chunk_height * ctx.tile_height * height_scale),
+                                       image=chunk[0], anchor=NW, tags='image')
+    ctx.canvas.tag_lower(chunk[1])
+
+def hide_chunks():
+    # Remove chunks from the canvas, but keep their images for when we return to their zoom level
     ctx.canvas.delete('image')
-    if len(ctx.tiles) == 0:
-        ctx.canvas.image = None
+    for chunk in ctx.chunks.values():
+        chunk[1] = None
+
+def drop_chunks():
+    ctx.canvas.delete('image')
+    ctx.chunks.clear()
+    ctx.chunks_size = 0
+
+def schedule_viewport_update():
+    if not ctx.viewport_pending:
+        ctx.viewport_pending = True
+        ctx.canvas.after_idle(update_viewport)
+
+def update_viewport():
+    ctx.viewport_pending = False
+    if len(ctx.tiles) == 0 or ctx.width == 0 or ctx.height == 0:
         return
-    
-    img = PhotoImage(width=ctx.tile_width * ctx.width, height=ctx.tile_height * ctx.height)
-    ctx.canvas.image = img
-    for x in range(0, ctx.width):
-        for y in range(0, ctx.height):
-            draw_map_tile(x, y)
-    if ctx.mode == 0:
-        img = img.zoom(2, 1)
-    elif ctx.mode == 2:
-        img = img.zoom(1, 2)
-    ctx.canvas.img = img
-    adjust_zoom(0, True)
 
-def redraw_tiles():
-    ctx.tiles_canvas.delete('all')
+    # Work out the chunks covering the visible region, plus a chunk of margin
+    width_scale = (2 if ctx.mode == 0 else 1) * ctx.zoom
+    height_scale = (2 if ctx.mode == 2 else 1) * ctx.zoom
+    (chunk_width, chunk_height) = get_chunk_size()
+    chunk_pixel_width = chunk_width * ctx.tile_width * width_scale
+    chunk_pixel_height = chunk_height * ctx.tile_height * height_scale
+    left = ctx.canvas.canvasx(0)
+    top = ctx.canvas.canvasy(0)
+    cx1 = max(0, int(left // chunk_pixel_width) - 1)
+    cy1 = max(0, int(top // chunk_pixel_height) - 1)
+    cx2 = min(math.ceil(ctx.width / chunk_width),
+              int((left + ctx.canvas.winfo_width()) // chunk_pixel_width) + 2)
+    cy2 = min(math.ceil(ctx.height / chunk_height),
+              int((top + ctx.canvas.winfo_height()) // chunk_pixel_height) + 2)
+
+    visible = set()
+    for cy in range(cy1, cy2):
+        for cx in range(cx1, cx2):
+            key = (ctx.zoom, cx, cy)
+            visible.add(key)
+            chunk = ctx.chunks.get(key)
+            if chunk is not None:
+                ctx.chunks.move_to_end(key)
+            else:
+                chunk = render_chunk(cx, cy)
+                ctx.chunks[key] = chunk
+                ctx.chunks_size += chunk[2]
+            if chunk[1] is None:
+                show_chunk(cx, cy, chunk)
+
+    # Evict the least recently used chunks that are out of view
+    while ctx.chunks_size > CHUNK_BUDGET:
+        key = next(iter(ctx.chunks))
+        if key in visible:
+            break
+        chunk = ctx.chunks.pop(key)
+        if chunk[1] is not None:
+            ctx.canvas.delete(chunk[1])
+        ctx.chunks_size -= chunk[2]
+
+def redraw_dirty():
+    dirty = ctx.dirty
+    ctx.dirty = []
+    if len(ctx.tiles) == 0 or len(dirty) == 0:
+        return
+
+    # Past a point, it's cheaper to render the whole map in one go
+    area = sum((x2 - x1) * (y2 - y1) for (x1, y1, x2, y2) in dirty)
+    if area * 2 > ctx.width * ctx.height:
+        redraw_map()
+        return
 
+    # Drop chunks at other zoom levels that the dirty cells touch
+    sizes = {}
+    for key in list(ctx.chunks):
+        (zoom, cx, cy) = key
+        if zoom == ctx.zoom:
+            continue
+        if zoom not in sizes:
+            sizes[zoom] = get_chunk_size(zoom)
+        (chunk_width, chunk_height) = sizes[zoom]
+        for (x1, y1, x2, y2) in dirty:
+            if x1 < (cx + 1) * chunk_width and cx * chunk_width < x2 and \
+               y1 < (cy + 1) * chunk_height and cy * chunk_height < y2:
+                ctx.chunks_size -= ctx.chunks.pop(key)[2]
+                break
+
+    # Render the dirty cells of any resident chunks and copy them in at zoom
+    width_scale = (2 if ctx.mode == 0 else 1) * ctx.zoom
+    height_scale = (2 if ctx.mode == 2 else 1) * ctx.zoom
+    (chunk_width, chunk_height) = get_chunk_size()
+    for (x1, y1, x2, y2) in dirty:
+        for cy in range(y1 // chunk_height, (y2 - 1) // chunk_height + 1):
+            for cx in range(x1 // chunk_width, (x2 - 1) // chunk_width + 1):
+                chunk = ctx.chunks.get((ctx.zoom, cx, cy))
+                if chunk is None:
+                    continue
+                ix1 = max(x1, cx * chunk_width)
+                iy1 = max(y1, cy * chunk_height)
+                ix2 = min(x2, (cx + 1) * chunk_width)
+                iy2 = min(y2, (cy + 1) * chunk_height)
+                img = PhotoImage(data=render_map(ix1, iy1, ix2, iy2), format='PPM')
+                ctx.canvas.tk.call(chunk[0], 'copy', img,
+                                   '-to', (ix1 - cx * chunk_width) * ctx.tile_width * width_scale,
+                                          (iy1 - cy * chunk_height) * ctx.tile_height * height_scale,
+                                   '-zoom', width_scale, height_scale)
+
+def redraw_map():
+    ctx.dirty = []
+    drop_chunks()
+    adjust_zoom(0, True)
+
+def get_strip_layout():
+    # Returns the tile strip scale and padded cell size in pixels
     width_scale = 4 if ctx.mode == 0 else 2 if ctx.mode == 2 else 1
     height_scale = 2
+    return (width_scale, height_scale,
+            (ctx.tile_width * width_scale) + 2, (ctx.tile_height * height_scale) + 2)
+
+def get_strip_rows(index):
+    # Rows of raw RGB data for a tile in the strip, scaled horizontally
+    rows = get_tile_rows(index)
+    key = ('strip', index)
+    strip = ctx.tile_cache.get(key)
+    if strip is None:
+        (width_scale, _, _, _) = get_strip_layout()
+        strip = [b''.join([row[i:i+3] * width_scale for i in range(0, len(row), 3)]) for row in rows]
+        ctx.tile_cache[key] = strip
+    return strip
+
+def render_tiles(first, last):
+    # Render the tile strip columns first to last (exclusive) to binary PPM data
+    (width_scale, height_scale, padded_tile_width, padded_tile_height) = get_strip_layout()
+    width = (last - first) * padded_tile_width
+    gap = b'\xff\xff\xff' * 2
+    blank = b'\xff\xff\xff' * (padded_tile_width - 2)
+    pixels = bytearray(b'\xff\xff\xff' * width * 2)
+    for row in range(2):
+        strips = [get_strip_rows(index) if index < len(ctx.tiles) else None
+                  for index in range(first * 2 + row, last * 2, 2)]
+        for y in range(ctx.tile_height * height_scale):
+            pixels += b''.join([gap + (strip[y // height_scale] if strip else blank) for strip in strips])
+        pixels += b'\xff\xff\xff' * width * 2
+    return ppm_data(width, padded_tile_height * 2 + 2, pixels)
+
+def tile_at(x, y):
+    # Returns the index of the tile at the given tiles canvas window coordinates, or None
+    (_, _, padded_tile_width, padded_tile_height) = get_strip_layout()
+    x = int(ctx.tiles_canvas.canvasx(x))
+    y = int(ctx.tiles_canvas.canvasy(y))
+    column = x // padded_tile_width
+    row = y // padded_tile_height
+    if x < 0 or row < 0 or row > 1 or x % padded_tile_width < 2 or y % padded_tile_height < 2:
+        return None
+    index = column * 2 + row
+    return index if index < len(ctx.tiles) else None
+
+def redraw_tiles():
+    if ctx.tiles_atlas is not None:
+        ctx.tiles_canvas.delete(ctx.tiles_atlas[1])
+        ctx.tiles_atlas = None
 
-    padded_tile_width = (ctx.tile_width * width_scale)+2
-    padded_tile_height = (ctx.tile_height * height_scale)+2
-    width = padded_tile_width * (len(ctx.tiles) // 2) + 2
+    (_, _, padded_tile_width, padded_tile_height) = get_strip_layout()
+    width = padded_tile_width * ((len(ctx.tiles) + 1) // 2) + 2
     height = padded_tile_height * 2 + 2
 
     ctx.tiles_canvas.config(scrollregion=(0, 0, width, height))
     ctx.main_frame.grid_rowconfigure(1, minsize=height + 16) # TODO: 16 - we should get the scrollbar height...
 
-    column = 0
-    row = 0
-    index = 0
-    ctx.tiles_canvas.images = []
-    for tile in ctx.tiles:
-        img = PhotoImage(width=ctx.tile_width, height=ctx.tile_height)
-        draw_tile(tile, img, 0, 0)
-        img = img.zoom(width_scale, height_scale)
+    update_tiles_viewport()
+
+def schedule_tiles_update():
+    if not ctx.tiles_pending:
+        ctx.tiles_pending = True
+        ctx.tiles_canvas.after_idle(update_tiles_viewport)
 
-        ctx.tiles_canvas.create_image((2 + (column * padded_tile_width), 2 + (row * padded_tile_height)), image=img, anchor=NW, tags=[str(index)])
-        ctx.tiles_canvas.images.append(img)
+def update_tiles_viewport():
+    ctx.tiles_pending = False
+    if len(ctx.tiles) == 0:
+        return
 
-        index += 1
-        row += 1
-        if row == 2:
-            row = 0
-            column += 1
+    # Nothing to do if the visible columns are already rendered
+    (_, _, padded_tile_width, _) = get_strip_layout()
+    columns = (len(ctx.tiles) + 1) // 2
+    left = ctx.tiles_canvas.canvasx(0)
+    first = max(0, int(left // padded_tile_width))
+    last = min(columns, int((left + ctx.tiles_canvas.winfo_width()) // padded_tile_width) + 1)
+    atlas = ctx.tiles_atlas
+    if atlas is not None and atlas[2] <= first and last <= atlas[3]:
+        return
+
+    # Render the visible columns, plus a screen of margin either side, as one image
+    margin = last - first
+    first = max(0, first - margin)
+    last = min(columns, last + margin)
+    img = PhotoImage(data=render_tiles(first, last), format='PPM')
+    item = ctx.tiles_canvas.create_image((first * padded_tile_width, 0), image=img, anchor=NW)
+    if atlas is not None:
+        ctx.tiles_canvas.delete(atlas[1])
+    ctx.tiles_atlas = [img, item, first, last]
+
+def update_tiles(indices):
+    # Re-render the given tiles in place, if they're in the rendered part of the strip
+    atlas = ctx.tiles_atlas
+    if atlas is None:
+        return
+    (width_scale, height_scale, padded_tile_width, padded_tile_height) = get_strip_layout()
+    for index in indices:
+        column = index // 2
+        if column < atlas[2] or column >= atlas[3]:
+            continue
+        img = PhotoImage(data=ppm_data(ctx.tile_width, ctx.tile_height, b''.join(get_tile_rows(index))),
+                         format='PPM')
+        ctx.tiles_canvas.tk.call(atlas[0], 'copy', img,
+                                 '-to', (column - atlas[2]) * padded_tile_width + 2,
+                                        (index % 2) * padded_tile_height + 2,
+                                 '-zoom', width_scale, height_scale)
 
 def toggle_grid():
     ctx.draw_grid = not ctx.draw_grid
@@ -1217,6 +2240,9 @@ class ImportDialog(simpledialog.Dialog):
         self.tileWidthEntry.grid(row=1, column=1, sticky=EW)
         self.tileHeightEntry.grid(row=2, column=1, sticky=EW)
 
+        self.flips = IntVar()
+        ttk.Checkbutton(master, text='De-dupe mirrored/flipped tiles', variable=self.flips).grid(row=3, column=0, columnspan=2, sticky=W, padx=5, pady=5)
+
         # Populate default values
         self.modeEntry.delete(0)
         self.modeEntry.insert(0, '0')
@@ -1254,35 +2280,80 @@ class ImportDialog(simpledialog.Dialog):
             'mode': mode,
             'tile_width': tile_width,
             'tile_height': tile_height,
+            'flips': self.flips.get() != 0,
         }
         self.destroy()
 
-def validate_png(read, scanlines, mode, tile_width, tile_height):
+def validate_png(read, mode, tile_width, tile_height):
     width = read[0]
     height = read[1]
     info = read[3]
 
     if 'palette' not in info:
-        messagebox.showerror('Import error', 'PNG file is not palettised.')
-        return False
+        raise ValueError('PNG file is not palettised.')
     
-    max_colours = 16 if mode == 0 else (4 if mode == 1 else 2)
+    if width % tile_width != 0 or height % tile_height != 0:
+        raise ValueError('Invalid tile size of %dx%d for image size of %dx%d' %
+                         (tile_width, tile_height, width, height))
 
-    palette = info['palette']
+def validate_scanlines(scanlines, palette, mode):
+    max_colours = 16 if mode == 0 else (4 if mode == 1 else 2)
     if len(palette) > max_colours:
         # Check if any of the extra colours are referenced
         for line in scanlines:
-            for col in range(0, width):
-                if line[col] >= max_colours:
-                    messagebox.showerror('Import error', 'PNG uses too many colours for mode %d (%d > 16, found index %d)' % (mode, len(palette), line[col]))
-                    return False
-    
-    if width % tile_width != 0 or height % tile_height != 0:
-        messagebox.showerror('Import error', 'Invalid tile size of %dx%d for image size of %dx%d' %
-                             (tile_width, tile_height, width, height))
-        return False
-    
-    return True
+            if max(line) >= max_colours:
+                raise ValueError('PNG uses too many colours for mode %d (%d > 16, found index %d)' % (mode, len(palette), max(line)))
+
+def png_palette(info, mode):
+    # Convert colours to hex codes
+    max_colours = 16 if mode == 0 else (4 if mode == 1 else 2)
+    palette = ['#%02x%02x%02x' % c[0:3] for c in info['palette'][0:max_colours]]
+    for __unused_color__ in range(len(palette), max_colours):
+        palette.append('#000000')
+    return palette
+
+def import_png(filename, mode, tile_width, tile_height, tiles=[], flips=False):
+    # Returns (width, height, palette, tiles, map), with any existing tiles
+    # keeping their indices. If flips is set, tiles that are mirrored or
+    # flipped versions of another tile are stored once, with the flips
+    # recorded in the map values
+    input = png.Reader(filename=filename).read()
+    validate_png(input, mode, tile_width, tile_height)
+    width = input[0] // tile_width
+    height = input[1] // tile_height
+
+    # Build tile map and unique tiles list, one band of tile rows at a time
+    unique_tiles = list(tiles)
+    keys = {} # Tile (or canonical tile) -> (tile index, flags of stored tile)
+    for i in range(len(tiles)):
+        (key, flags) = orient_tile(tiles[i], mode, tile_width) if flips else (tiles[i], 0)
+        keys.setdefault(key, (i, flags))
+    tile_map = array('H', bytes(2 * width * height))
+    scanlines = iter(input[2])
+    for y in range(0, height):
+        band = list(itertools.islice(scanlines, tile_height))
+        validate_scanlines(band, input[3]['palette'], mode)
+        for (x, tile) in enumerate(encode_band(band, mode, tile_width)):
+            (key, flags) = orient_tile(tile, mode, tile_width) if flips else (tile, 0)
+            entry = keys.get(key)
+            if entry is None:
+                if len(unique_tiles) > TILE_INDEX:
+                    raise ValueError('Too many unique tiles (more than %d)' % (TILE_INDEX + 1))
+                entry = keys[key] = (len(unique_tiles), flags)
+                unique_tiles.append(tile)
+            tile_map[x * height + y] = entry[0] | (flags ^ entry[1])
+
+    # Number new tiles in column-major order of first use
+    new_tiles = unique_tiles[0:len(tiles)]
+    remap = list(range(len(tiles))) + [None] * (len(unique_tiles) - len(tiles))
+    for value in tile_map:
+        index = value & TILE_INDEX
+        if remap[index] is None:
+            remap[index] = len(new_tiles)
+            new_tiles.append(unique_tiles[index])
+
+    return (width, height, png_palette(input[3], mode), new_tiles,
+            array('H', [remap[value & TILE_INDEX] | (value & TILE_FLIPS) for value in tile_map]))
 
 def import_file(root, replace=False):
     filetypes = [('PNG files', '*.png')]
@@ -1300,75 +2371,20 @@ def import_file(root, replace=False):
             'mode': ctx.mode,
             'tile_width': ctx.tile_width,
             'tile_height': ctx.tile_height,
+            'flips': ctx.flips,
         }
 
-    input = png.Reader(filename=filename).read()
-    scanlines = list(input[2])
-    if not validate_png(input, scanlines, options['mode'], options['tile_width'], options['tile_height']):
+    try:
+        ctx.import_map(filename, options['mode'], options['tile_width'], options['tile_height'], replace,
+                       options['flips'])
+    except ValueError as e:
+        messagebox.showerror('Import error', str(e))
         return
-    
-    max_colours = 16 if options['mode'] == 0 else (4 if options['mode'] == 1 else 2)
-    pixels_per_byte = 2 if options['mode'] == 0 else (4 if options['mode'] == 1 else 8)
-
-    # Validation success, actually import map
-    width = input[0]
-    height = input[1]
-    info = input[3]
-    palette = info['palette'][0:max_colours]
-    
-    if not replace:
-        ctx.name = None
-        ctx.mode = options['mode']
-        ctx.tile_width = options['tile_width']
-        ctx.tile_height = options['tile_height']
-    (old_width, old_height) = (ctx.width, ctx.height)
-    ctx.width = int(width / options['tile_width'])
-    ctx.height = int(height / options['tile_height'])
-
-    # Convert colours to hex codes
-    ctx.palette = ['#%02x%02x%02x' % c[0:3] for c in palette]
-    for __unused_color__ in range(len(palette), max_colours):
-        ctx.palette.append('#000000')
-
-    # Build tile map and unique tiles list
-    tiles = collections.OrderedDict()
-    if replace:
-        for i in range(len(ctx.tiles)):
-            tiles[ctx.tiles[i]] = i
-    ctx.map = []
-
-    for col in range(0, width, ctx.tile_width):
-        for row in range(0, height, ctx.tile_height):
-            tile = []
-            for scanline in scanlines[row:row+ctx.tile_height]:
-                for offset in range(col, col+ctx.tile_width, pixels_per_byte):
-                    tile.append(get_byte(scanline, offset, ctx.mode))
-            tile = bytes(tile)
-            if tile in tiles:
-                ctx.map.append(tiles[tile])
-            else:
-                ctx.map.append(len(tiles))
-                tiles[tile] = len(tiles)
-
-    ctx.tiles = list(tiles.keys())
-    new_tags = [0 for x in range(ctx.width * ctx.height)]
-    new_notes = ['' for x in range(ctx.width * ctx.height)]
-    if replace:
-        # Copy old tags into new tags
-        for y in range(0, min(old_height, ctx.height)):
-            for x in range(0, min(old_width, ctx.width)):
-                old_i = x * old_height + y
-                new_i = x * ctx.height + y
-                new_tags[new_i] = ctx.tags[old_i]
-                new_notes[new_i] = ctx.notes[old_i]
-    ctx.tags = new_tags
-    ctx.notes = new_notes
 
+    invalidate_tile_cache()
     if not replace:
-        ctx.data_tree.delete(*ctx.data_tree.get_children())
-        ctx.entities = []
-        ctx.entity_tree.delete(*ctx.entity_tree.get_children())
-        ctx.entity_data_tree.delete(*ctx.entity_data_tree.get_children())
+        refresh_data_tree()
+        refresh_entity_tree()
 
     refresh_ui()
 
@@ -1378,47 +2394,13 @@ def import_tiles(root):
     if filename == '':
         return
 
-    input = png.Reader(filename=filename).read()
-    scanlines = list(input[2])
-    if not validate_png(input, scanlines, ctx.mode, ctx.tile_width, ctx.tile_height):
+    try:
+        ctx.import_tiles(filename)
+    except ValueError as e:
+        messagebox.showerror('Import error', str(e))
         return
 
-    width = input[0]
-    height = input[1]
-    pixels_per_byte = 2 if ctx.mode == 0 else (4 if ctx.mode == 1 else 8)
-
-    if len(ctx.tiles) == 0:
-        palette = input[3]['palette']
-        max_colours = 16 if ctx.mode == 0 else (4 if ctx.mode == 1 else 2)
-        ctx.palette = ['#%02x%02x%02x' % c for c in palette]
-        for __unused_color__ in range(len(palette), max_colours):
-            ctx.palette.append('#000000')
-
-    # Add new tiles (TODO: Share code with import_file)
-    new_tiles = collections.OrderedDict()
-    for col in range(0, width, ctx.tile_width):
-        for row in range(0, height, ctx.tile_height):
-            tile = []
-            for scanline in scanlines[row:row+ctx.tile_height]:
-                for offset in range(col, col+ctx.tile_width, pixels_per_byte):
-                    tile.append(get_byte(scanline, offset, ctx.mode))
-            tile = bytes(tile)
-            if tile not in new_tiles:
-                new_tiles[tile] = len(new_tiles)
-
-    for i in range(len(ctx.map)):
-        tile = ctx.tiles[ctx.map[i]]
-        if tile in new_tiles:
-            ctx.map[i] = new_tiles[tile]
-        else:
-            ctx.map[i] = len(new_tiles)
-            new_tiles[tile] = tile
-    
-    ctx.tiles = list(new_tiles.keys())
-    
-    if len(ctx.map) != ctx.width * ctx.height:
-        ctx.map = [0 for i in range(ctx.width * ctx.height)]
-
+    invalidate_tile_cache()
     refresh_ui()
 
 
@@ -1430,29 +2412,40 @@ class ExportBinaryDialog(simpledialog.Dialog):
     def export_map_cb(self):
         for radio in self.map_radios:
             radio.configure(state=NORMAL if self.export_map.get() == 1 or self.export_tags.get() == 1 else DISABLED)
+        self.flips_check.configure(state=NORMAL if self.export_map.get() == 1 else DISABLED)
 
     def body(self, master):
         master.pack(expand=True, fill=BOTH)
 
         self.export_map = IntVar()
-        ttk.Checkbutton(master, text='Export map', variable=self.export_map, command=self.export_map_cb).grid(row=0, column=0, sticky=W)
+        ttk.Checkbutton(master, text='Export map', variable=self.export_map, command=self.export_map_cb).grid(row=1, column=0, sticky=W)
         self.export_tags = IntVar()
-        ttk.Checkbutton(master, text='Export tags', variable=self.export_tags, command=self.export_map_cb).grid(row=1, column=0, sticky=W)
+        ttk.Checkbutton(master, text='Export tags', variable=self.export_tags, command=self.export_map_cb).grid(row=2, column=0, sticky=W)
         self.is_row_major = IntVar()
         self.map_radios = [Radiobutton(master, text='Column-major', value=0, variable=self.is_row_major, state=DISABLED)]
-        self.map_radios[0].grid(row=2, column=0, sticky=W)
+        self.map_radios[0].grid(row=3, column=0, sticky=W)
         self.map_radios.append(Radiobutton(master, text='Row-major', value=1, variable=self.is_row_major, state=DISABLED))
-        self.map_radios[1].grid(row=3, column=0, sticky=W)
+        self.map_radios[1].grid(row=4, column=0, sticky=W)
+        self.flips = IntVar(value=1 if ctx.flips else 0)
+        self.flips_check = ttk.Checkbutton(master, text='Flips in top two bits', variable=self.flips, state=DISABLED)
+        self.flips_check.grid(row=3, column=1, sticky=W, padx=5)
         self.export_tiles = IntVar()
-        ttk.Checkbutton(master, text='Export tiles', variable=self.export_tiles).grid(row=4, column=0, sticky=W)
+        ttk.Checkbutton(master, text='Export tiles', variable=self.export_tiles).grid(row=5, column=0, sticky=W)
         self.export_tile_tags = IntVar()
-        ttk.Checkbutton(master, text='Export unique tags per tile', variable=self.export_tile_tags).grid(row=5, column=0, sticky=W)
+        ttk.Checkbutton(master, text='Export unique tags per tile', variable=self.export_tile_tags).grid(row=6, column=0, sticky=W)
         self.export_entities = IntVar()
-        ttk.Checkbutton(master, text='Export entities', variable=self.export_entities).grid(row=6, column=0, sticky=W)
+        ttk.Checkbutton(master, text='Export entities', variable=self.export_entities).grid(row=7, column=0, sticky=W)
         self.export_data = IntVar()
-        ttk.Checkbutton(master, text='Export data', variable=self.export_data).grid(row=7, column=0, sticky=W)
+        ttk.Checkbutton(master, text='Export data', variable=self.export_data).grid(row=8, column=0, sticky=W)
         self.export_palette = IntVar()
-        ttk.Checkbutton(master, text='Export palette', variable=self.export_palette).grid(row=8, column=0, sticky=W)
+        ttk.Checkbutton(master, text='Export palette', variable=self.export_palette).grid(row=9, column=0, sticky=W)
+
+        # Compression per stream
+        ttk.Label(master, text='Compression').grid(row=0, column=1, sticky=W, padx=5)
+        self.codecs = {}
+        for (kind, row) in [('map', 1), ('tags', 2), ('tiles', 5), ('entities', 7)]:
+            self.codecs[kind] = StringVar(value='none')
+            ttk.Combobox(master, textvariable=self.codecs[kind], values=CODECS, state='readonly', width=10).grid(row=row, column=1, sticky=W, padx=5)
     
     def buttonbox(self):
         ttk.Button(self, text='OK', width=6, command=self.ok_pressed).pack(side=RIGHT, padx=5, pady=5)
@@ -1464,108 +2457,224 @@ class ExportBinaryDialog(simpledialog.Dialog):
             'export_map': self.export_map.get() == 1,
             'export_tags': self.export_tags.get() == 1,
             'row_major': self.is_row_major.get() == 1,
+            'flips': self.flips.get() == 1,
             'export_tiles': self.export_tiles.get() == 1,
             'export_tile_tags': self.export_tile_tags.get() == 1,
             'export_entities': self.export_entities.get() == 1,
             'export_data': self.export_data.get() == 1,
             'export_palette': self.export_palette.get() == 1,
+            'codecs': {kind: codec.get() for (kind, codec) in self.codecs.items()},
         }
         self.destroy()
 
+EXPORT_KINDS = ['map', 'tags', 'tiles', 'tile_tags', 'entities', 'data', 'palette']
+
+def map_binary(values, width, height, row_major=False):
+    # Returns one byte per cell, column by column, or row by row with row_major
+    if len(values) > 0 and max(values) > 255:
+        raise ValueError('Map values must be below 256 to export (found %d)' % max(values))
+    cells = values if isinstance(values, (bytes, bytearray)) else bytearray(iter(values))
+    if not row_major:
+        return bytes(cells)
+    # Row y is every height-th cell starting from y
+    return b''.join([cells[y::height] for y in range(height)])
+
+def tile_tags_binary(unique_tags, n_tiles):
+    return bytes([unique_tags.get(i, 0) for i in range(n_tiles)])
+
+def entities_binary(entities):
+    # Type, tx, sx, ty, sy, then data
+    return bytes([value for e in entities for value in e[0:5] + [d[0] for d in e[6]]])
+
+def data_binary(data):
+    return bytes([int(d[1]) for d in data])
+
+def palette_binary(palette):
+    # TODO: Offer more colour formats than just 12-bit Plus colours
+    return b''.join([struct.pack('<H', int(c[3] + c[1] + c[5], 16)) for c in palette])
+
+CODECS = ['none', 'rle', 'column-rle', 'lz4']
+CODEC_KINDS = ['map', 'tags', 'tiles', 'entities'] # Binaries that can be compressed
+
+def rle_encode(data):
+    # PackBits RLE: a header byte n of 0-127 is followed by n + 1 literal bytes, and
+    # a header of 257 - n (129-255) by one byte to repeat n times
+    out = bytearray()
+    literals = bytearray()
+    for (value, run) in itertools.groupby(data):
+        count = sum(1 for x in run)
+        if count < 3 and not (count == 2 and len(literals) == 0):
+            literals.extend([value] * count)
+            continue
+        for i in range(0, len(literals), 128):
+            chunk = literals[i:i + 128]
+            out.append(len(chunk) - 1)
+            out.extend(chunk)
+        literals = bytearray()
+        while count > 0:
+            if count == 1:
+                literals.append(value)
+                break
+            repeat = min(count, 128)
+            out.extend([257 - repeat, value])
+            count -= repeat
+    for i in range(0, len(literals), 128):
+        chunk = literals[i:i + 128]
+        out.append(len(chunk) - 1)
+        out.extend(chunk)
+    return bytes(out)
+
+def column_rle_encode(data, column_size):
+    # A little-endian 16-bit offset from the start of the output to each column, then
+    # each column of column_size bytes packed separately with rle_encode, so that
+    # columns can be unpacked one at a time (e.g. when scrolling)
+    columns = [rle_encode(data[i:i + column_size]) for i in range(0, len(data), column_size)]
+    starts = []
+    offset = 2 * len(columns)
+    for column in columns:
+        starts.append(offset)
+        offset += len(column)
+    if len(starts) > 0 and starts[-1] > 0xffff:
+        raise ValueError('Column-RLE data is too large for 16-bit offsets (last column at %d bytes)' % starts[-1])
+    return struct.pack('<%dH' % len(starts), *starts) + b''.join(columns)
+
+def lz4_encode(data):
+    # LZ4 block format (no frame header), as unpacked by the usual Z80 LZ4 depackers
+    data = bytes(data)
+    out = bytearray()
+
+    def lengths(n):
+        while n >= 255:
+            out.append(255)
+            n -= 255
+        out.append(n)
+
+    def sequence(literals, offset=0, length=4):
+        out.append((min(len(literals), 15) << 4) | min(length - 4, 15))
+        if len(literals) >= 15:
+            lengths(len(literals) - 15)
+        out.extend(literals)
+        if offset > 0:
+            out.extend(struct.pack('<H', offset))
+            if length - 4 >= 15:
+                lengths(length - 19)
+
+    # The format needs the last match to start at least 12 bytes from the end and
+    # the last 5 bytes to be literals
+    positions = {} # Last position of each 4 byte string
+    (anchor, i) = (0, 0)
+    while i < len(data) - 12:
+        candidate = positions.get(data[i:i + 4])
+        positions[data[i:i + 4]] = i
+        if candidate is None or i - candidate > 0xffff:
+            i += 1
+            continue
+        length = 4
+        limit = len(data) - 5 - i
+        while length < limit and data[candidate + length] == data[i + length]:
+            length += 1
+        sequence(data[anchor:i], i - candidate, length)
+        for j in range(i + 1, min(i + length, len(data) - 12)):
+            positions[data[j:j + 4]] = j
+        i += length
+        anchor = i
+    sequence(data[anchor:])
+    return bytes(out)
+
+def encode_binary(data, codec, chunk_size=1):
+    # Compresses a binary with the given codec (see CODECS). Column-RLE packs chunks
+    # of chunk_size bytes (map columns or rows, tiles or entities) separately
+    if codec == 'rle':
+        return rle_encode(data)
+    elif codec == 'column-rle':
+        return column_rle_encode(data, chunk_size)
+    elif codec == 'lz4':
+        return lz4_encode(data)
+    return bytes(data)
+
+def export_chunk_size(doc, kind, row_major=False):
+    # Returns the size of each column, row, tile or entity in a binary export
+    if kind in ('map', 'tags'):
+        return doc.width if row_major else doc.height
+    elif kind == 'tiles':
+        return len(doc.tiles[0]) if len(doc.tiles) > 0 else 1
+    elif kind == 'entities':
+        return 5 + doc.entity_size
+    return 1
+
+def export_report(kind, raw_size, data, codec):
+    if codec == 'none':
+        return '%s: %d bytes' % (kind, len(data))
+    return '%s: %d bytes, %s %d bytes (%.1f%%)' % \
+        (kind, raw_size, codec, len(data), 100 * len(data) / max(raw_size, 1))
+
+def export_binary(doc, kind, row_major=False, codec='none', flips=None):
+    # Returns the contents of a binary export of the given kind (see EXPORT_KINDS),
+    # compressed with the given codec, and its size before compression. Flips
+    # overrides whether the map binary carries tile flips (see Document.get_export_map)
+    data = export_raw_binary(doc, kind, row_major, flips)
+    return (encode_binary(data, codec, export_chunk_size(doc, kind, row_major)), len(data))
+
+def export_raw_binary(doc, kind, row_major=False, flips=None):
+    if kind == 'map':
+        return map_binary(doc.get_export_map(flips), doc.width, doc.height, row_major)
+    elif kind == 'tags':
+        return map_binary(doc.tags, doc.width, doc.height, row_major)
+    elif kind == 'tiles':
+        return b''.join(doc.tiles)
+    elif kind == 'tile_tags':
+        return tile_tags_binary(doc.get_unique_cell_tags(), len(doc.tiles))
+    elif kind == 'entities':
+        return entities_binary(doc.entities)
+    elif kind == 'data':
+        return data_binary(doc.data)
+    elif kind == 'palette':
+        return palette_binary(doc.palette)
+
+def write_binary(filename, data):
+    with open(filename, 'wb') as file:
+        file.write(data)
+
 def export_binaries(root):
     options = ExportBinaryDialog(root).result
     if options is None:
         return
     
     filetypes = [('BIN files', '*.bin')]
-    
-    if options['export_map']:
-        if ctx.width == 0 or ctx.height == 0:
-            messagebox.showerror('Export binaries', 'Map is incomplete')
-        else:
-            filename = filedialog.asksaveasfilename(title='Save map binary', filetypes=filetypes, defaultextension='bin')
-            if filename != '':
-                with open(filename, 'wb') as file:
-                    for i in range(ctx.width * ctx.height):
-                        idx = ((i % ctx.height) * ctx.width + (i // ctx.width)) if options['row_major'] else i
-                        file.write(ctx.map[idx].to_bytes(1, 'little'))
-    
-    if options['export_tags']:
-        if ctx.width == 0 or ctx.height == 0:
-            messagebox.showerror('Export binaries', 'Map is incomplete')
-        else:
-            filename = filedialog.asksaveasfilename(title='Save map tags binary', filetypes=filetypes, defaultextension='bin')
-            if filename != '':
-                with open(filename, 'wb') as file:
-                    for i in range(ctx.width * ctx.height):
-                        idx = ((i % ctx.height) * ctx.width + (i // ctx.width)) if options['row_major'] else i
-                        file.write(ctx.tags[idx].to_bytes(1, 'little'))
-    
-    if options['export_tiles']:
-        if len(ctx.tiles) < 1:
-            messagebox.showinfo('Export binaries', 'No tiles to export')
-        else:
-            filename = filedialog.asksaveasfilename(title='Save tiles binary', filetypes=filetypes, defaultextension='bin')
-            if filename != '':
-                with open(filename, 'wb') as file:
-                    for tile in ctx.tiles:
-                        file.write(tile)
-    
-    if options['export_tile_tags']:
-        if len(ctx.tiles) < 1:
-            messagebox.showinfo('Export binaries', 'No tiles to derive unique tags from')
-        else:
-            filename = filedialog.asksaveasfilename(title='Save tile tags binary', filetypes=filetypes, defaultextension='bin')
-            if filename != '':
-                with open(filename, 'wb') as file:
-                    unique_tags = get_unique_cell_tags()
-                    for i in range(len(ctx.tiles)):
-                        if i in unique_tags:
-                            file.write(unique_tags[i].to_bytes(1, 'little'))
-                        else:
-                            file.write(b'\x00')
-    
-    if options['export_entities']:
-        if len(ctx.entities) < 1:
-            messagebox.showinfo('Export binaries', 'No entities to export')
-        else:
-            filename = filedialog.asksaveasfilename(title='Save entities binary', filetypes=filetypes, defaultextension='bin')
-            if filename != '':
-                with open(filename, 'wb') as file:
-                    for e in ctx.entities:
-                        file.write(e[0].to_bytes(1, 'little'))  # type
-                        file.write(e[1].to_bytes(1, 'little'))  # tx
-                        file.write(e[2].to_bytes(1, 'little'))  # sx
-                        file.write(e[3].to_bytes(1, 'little'))  # ty
-                        file.write(e[4].to_bytes(1, 'little'))  # sy
-                        for d in e[6]: # data
-                            file.write(d[0].to_bytes(1, 'little'))
-    
-    if options['export_data']:
-        data = []
-        for datum in ctx.data_tree.get_children():
-            data.append(ctx.data_tree.item(datum)['values'])
-        if len(data) < 1:
-            messagebox.showinfo('Export binaries', 'No data to export')
-        else:
-            filename = filedialog.asksaveasfilename(title='Save data binary', filetypes=filetypes, defaultextension='bin')
-            if filename != '':
-                with open(filename, 'wb') as file:
-                    for d in data:
-                        #file.write(int(d[0]).to_bytes(1, 'little')) # id
-                        file.write(int(d[1]).to_bytes(1, 'little')) # value
-    
-    if options['export_palette']:
-        if len(ctx.palette) < 1:
-            messagebox.showinfo('Export binaries', 'No palette to export')
-        else:
-            filename = filedialog.asksaveasfilename(title='Save palette binary', filetypes=filetypes, defaultextension='bin')
-            if filename != '':
-                with open(filename, 'wb') as file:
-                    for c in ctx.palette:
-                        # TODO: Offer more colour formats than just 12-bit Plus colours
-                        colour = int(c[3] + c[1] + c[5], 16)
-                        file.write(struct.pack('<H', colour))
+    no_map = ctx.width == 0 or ctx.height == 0
+    reports = []
+
+    # Binary, save dialog title, whether there's nothing to export and why
+    for (kind, title, empty, message) in [
+            ('map', 'Save map binary', no_map, 'Map is incomplete'),
+            ('tags', 'Save map tags binary', no_map, 'Map is incomplete'),
+            ('tiles', 'Save tiles binary', len(ctx.tiles) < 1, 'No tiles to export'),
+            ('tile_tags', 'Save tile tags binary', len(ctx.tiles) < 1, 'No tiles to derive unique tags from'),
+            ('entities', 'Save entities binary', len(ctx.entities) < 1, 'No entities to export'),
+            ('data', 'Save data binary', len(ctx.data) < 1, 'No data to export'),
+            ('palette', 'Save palette binary', len(ctx.palette) < 1, 'No palette to export')]:
+        if not options['export_' + kind]:
+            continue
+        if empty:
+            if kind in ('map', 'tags'):
+                messagebox.showerror('Export binaries', message)
+            else:
+                messagebox.showinfo('Export binaries', message)
+            continue
+
+        codec = options['codecs'].get(kind, 'none')
+        try:
+            (data, raw_size) = export_binary(ctx, kind, options['row_major'], codec, options['flips'])
+        except ValueError as e:
+            messagebox.showerror('Export binaries', str(e))
+            continue
+        filename = filedialog.asksaveasfilename(title=title, filetypes=filetypes, defaultextension='bin')
+        if filename != '':
+            write_binary(filename, data)
+            reports.append(export_report(kind, raw_size, data, codec))
+
+    if len(reports) > 0:
+        messagebox.showinfo('Export binaries', '\n'.join(reports))
 
 def export_image(root):
     if len(ctx.tiles) < 1 or ctx.width == 0 or ctx.height == 0:
@@ -1578,31 +2687,34 @@ def export_image(root):
     if pathlib.Path(filename).suffix != '.png':
         filename = filename + '.png'
 
-    palette = []
-    for c in ctx.palette:
-        palette.append([int(c[1:3], 16), int(c[3:5], 16), int(c[5:7], 16)])
-    rows = [[] for __x in range(ctx.height * ctx.tile_height)]
-    for y in range(ctx.height):
-        for x in range(ctx.width):
-            i = x * ctx.height + y
-            for tiley in range(ctx.tile_height):
-                for tilex in range(ctx.tile_width):
-                    row = y * ctx.tile_height + tiley
-                    rows[row].append(get_pixel(ctx.tiles[ctx.map[i]], tilex, tiley))
-    output = png.Writer(ctx.width * ctx.tile_width, ctx.height * ctx.tile_height, palette=palette, bitdepth=8)
+    write_image(ctx, filename)
+
+def image_rows(doc):
+    # Yields the scanlines of the map image as bytes of palette indices, one band of
+    # tile rows at a time, decoding each distinct map value once
+    tile_rows = {}
+    for y in range(doc.height):
+        band = doc.map[y::doc.height]
+        for value in band:
+            if value not in tile_rows:
+                tile_rows[value] = [bytes(row) for row in decode_tile(doc.get_tile(value), doc.mode, doc.tile_width)]
+        tiles = [tile_rows[value] for value in band]
+        for tiley in range(doc.tile_height):
+            yield b''.join([tile[tiley] for tile in tiles])
+
+def write_image(doc, filename):
+    palette = [parse_colour(c) for c in doc.palette]
+    output = png.Writer(doc.width * doc.tile_width, doc.height * doc.tile_height, palette=palette, bitdepth=8)
     with open(filename, 'wb') as imagefile:
-        output.write(imagefile, rows)
+        output.write(imagefile, image_rows(doc))
 
 def open_file(root):
     filetypes = [('MAP files', '*.map')]
     filename = filedialog.askopenfilename(title='Open map', filetypes=filetypes)
     if filename == '':
         return
-    with ZipFile(filename, 'r') as mapfile:
-        with mapfile.open('map.json') as mapdata:
-            ctx.load(mapdata.read().decode())
-            ctx.name = filename
-            refresh_ui()
+    ctx.read(filename)
+    refresh_ui()
 
 def save_file(root, ignore_name = False):
     if ctx.map is None:
@@ -1615,8 +2727,7 @@ def save_file(root, ignore_name = False):
         if pathlib.Path(filename).suffix != '.map':
             filename = filename + '.map'
         ctx.name = filename
-    with ZipFile(ctx.name, 'w', compression=zipfile.ZIP_DEFLATED) as mapfile:
-        mapfile.writestr('map.json', ctx.toJSON())
+    ctx.write(ctx.name)
 
 def new_file(root):
     if not messagebox.askokcancel('New map', 'This will discard any current work, continue?'):
@@ -1631,6 +2742,90 @@ def refresh_ui():
     redraw_entities()
     update_status()
 
+def convert_file(filename, args):
+    # Headless conversion of a PNG image or .map file to binaries
+    doc = Document()
+    if args.command == 'build':
+        (tile_width, tile_height) = args.tile
+        doc.import_map(filename, args.mode, tile_width, tile_height, flips=args.flips)
+    else:
+        doc.read(filename)
+
+    name = pathlib.Path(filename).stem
+    reports = []
+    for kind in EXPORT_KINDS:
+        output = getattr(args, 'out_' + kind)
+        if output is not None:
+            codec = getattr(args, 'compress_' + kind, 'none')
+            (data, raw_size) = export_binary(doc, kind, args.row_major, codec, args.flips)
+            write_binary(output.format(name=name), data)
+            reports.append('\n  ' + export_report(kind, raw_size, data, codec))
+    if args.out_image is not None:
+        write_image(doc, args.out_image.format(name=name))
+
+    return '%s: %d x %d, %d tiles%s' % (filename, doc.width, doc.height, len(doc.tiles), ''.join(reports))
+
+def parse_tile_size(text):
+    (width, height) = text.lower().split('x')
+    return (int(width), int(height))
+
+def run_headless(argv):
+    parser = argparse.ArgumentParser(prog='maped.py', description='Amstrad CPC (Plus/GX4000) tile map editor. '
+                                     'Run without arguments to start the editor.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='convert PNG map images to binaries')
+    build.add_argument('inputs', nargs='+', metavar='PNG')
+    build.add_argument('--mode', type=int, choices=[0, 1, 2], default=0, help='CPC screen mode (default: 0)')
+    build.add_argument('--tile', type=parse_tile_size, default=(8, 16), metavar='WxH',
+                       help='tile size in pixels (default: 8x16)')
+    build.add_argument('--flips', action='store_true',
+                       help='store mirrored/flipped copies of a tile once, with the flips in the top two bits '
+                       'of the map values (at most 64 tiles)')
+    export = commands.add_parser('export', help='convert .map files to binaries')
+    export.add_argument('inputs', nargs='+', metavar='MAP')
+    export.add_argument('--flips', action=argparse.BooleanOptionalAction, default=None,
+                        help='write tile flips in the top two bits of the map values (default: as stored in the map)')
+    for command in (build, export):
+        command.add_argument('--out-map', metavar='FILE', help='map binary to write; {name} is replaced '
+                             'by the input file name without extension (the same goes for all outputs)')
+        command.add_argument('--out-tags', metavar='FILE', help='map tags binary to write')
+        command.add_argument('--out-tiles', metavar='FILE', help='tiles binary to write')
+        command.add_argument('--out-tile-tags', metavar='FILE', help='unique tags per tile binary to write')
+        command.add_argument('--out-entities', metavar='FILE', help='entities binary to write')
+        command.add_argument('--out-data', metavar='FILE', help='data binary to write')
+        command.add_argument('--out-palette', metavar='FILE', help='palette binary to write')
+        command.add_argument('--out-image', metavar='FILE', help='PNG image of the whole map to write')
+        command.add_argument('--row-major', action='store_true', help='write map and tags in row-major order')
+        for kind in CODEC_KINDS:
+            command.add_argument('--compress-' + kind, choices=CODECS, default='none',
+                                 help='compression for the %s binary (default: none)' % kind.replace('_', ' '))
+        command.add_argument('--jobs', type=int, default=None, metavar='N',
+                             help='number of files to convert in parallel (default: number of CPUs)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        pixels_per_byte = 2 if args.mode == 0 else (4 if args.mode == 1 else 8)
+        (tile_width, tile_height) = args.tile
+        if tile_width % pixels_per_byte != 0 or tile_width < 1 or tile_height < 1:
+            parser.error('Tile size of %dx%d invalid for mode %d' % (tile_width, tile_height, args.mode))
+    if len(args.inputs) > 1:
+        for output in (args.out_map, args.out_tags, args.out_tiles, args.out_tile_tags,
+                       args.out_entities, args.out_data, args.out_palette, args.out_image):
+            if output is not None and '{name}' not in output:
+                parser.error('Output file names must contain {name} when converting multiple files')
+
+    status = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(convert_file, filename, args) for filename in args.inputs]
+        for (filename, future) in zip(args.inputs, futures):
+            try:
+                print(future.result())
+            except Exception as e:
+                # Report any failure against its file and carry on with the others
+                print('%s: %s' % (filename, e), file=sys.stderr)
+                status = 1
+    return status
+
 def main():
     root = Tk()
     root.title('CPC Map editor')
@@ -1671,8 +2866,8 @@ def main():
 
     # Edit menu
     menu = Menu(ctx.menu, tearoff=0)
-    menu.add_command(label='Undo', underline=0, accelerator='Ctrl+Z', state='disabled')
-    menu.add_command(label='Redo', underline=0, accelerator='Ctrl+Y', state='disabled')
+    menu.add_command(label='Undo', underline=0, accelerator='Ctrl+Z', state='disabled', command=lambda: undo(root))
+    menu.add_command(label='Redo', underline=0, accelerator='Ctrl+Y', state='disabled', command=lambda: undo(root, True))
     menu.add_separator()
     menu.add_command(label='Cut', underline=2, accelerator='Ctrl+X', command=lambda: copy(root, True))
     menu.add_command(label='Copy', underline=0, accelerator='Ctrl+C', command=lambda: copy(root))
@@ -1680,8 +2875,10 @@ def main():
     menu.add_separator()
     menu.add_command(label='De-dupe cell tags', underline=0, accelerator='Ctrl+D', command=lambda: dedupe_cell_tags())
     menu.add_command(label='Remove unused tiles', underline=0, accelerator='Ctrl+Shift+R', command=lambda: remove_unused_tiles())
+    menu.add_command(label='Show uses of tile', underline=0, accelerator='Ctrl+U', command=lambda: show_tile_uses())
 
     ctx.menu.add_cascade(label='Edit', menu=menu)
+    ctx.edit_menu = menu
 
     # View menu
     menu = Menu(ctx.menu, tearoff=0)
@@ -1714,11 +2911,14 @@ def main():
     root.bind('<Control-t>', lambda e: toggle_tags())
     root.bind('<Control-T>', lambda e: toggle_entities())
     root.bind('<Control-p>', lambda e: PropertiesDialog(root))
+    root.bind('<Control-z>', lambda e: undo(root))
+    root.bind('<Control-y>', lambda e: undo(root, True))
     root.bind('<Control-x>', lambda e: copy(root, True))
     root.bind('<Control-c>', lambda e: copy(root))
     root.bind('<Control-v>', lambda e: paste(root))
     root.bind('<Control-d>', lambda e: dedupe_cell_tags())
     root.bind('<Control-R>', lambda e: remove_unused_tiles())
+    root.bind('<Control-u>', lambda e: show_tile_uses())
 
     # Main window layout
     ctx.main_frame = ttk.Frame(root)
@@ -1875,7 +3075,8 @@ def main():
     vbar.pack(side=RIGHT, fill=Y)
     vbar.config(command=ctx.canvas.yview)
 
-    ctx.canvas.config(xscrollcommand=hbar.set, yscrollcommand=vbar.set)
+    ctx.canvas.config(xscrollcommand=lambda *args: canvas_scrolled(hbar, *args),
+                      yscrollcommand=lambda *args: canvas_scrolled(vbar, *args))
     ctx.canvas.pack(side=LEFT, fill=BOTH, expand=True)
 
     # Hook up events for selection and zooming
@@ -1886,6 +3087,7 @@ def main():
     ctx.canvas.bind('<ButtonRelease-1>', canvas_release)
     ctx.canvas.bind('<Enter>', canvas_entered)
     ctx.canvas.bind('<Leave>', canvas_left)
+    ctx.canvas.bind('<Configure>', lambda e: schedule_viewport_update())
 
     root.bind('<Left>', lambda e: canvas_scroll(root, -1, 0))
     root.bind('<Right>', lambda e: canvas_scroll(root, 1, 0))
@@ -1899,12 +3101,16 @@ def main():
     hbar.pack(side=BOTTOM, fill=X)
     hbar.config(command=ctx.tiles_canvas.xview)
 
-    ctx.tiles_canvas.config(xscrollcommand=hbar.set)
+    ctx.tiles_canvas.config(xscrollcommand=lambda first, last: tiles_scrolled(hbar, first, last))
     ctx.tiles_canvas.pack(side=LEFT, fill=BOTH, expand=True)
+    ctx.tiles_canvas.bind('<Configure>', lambda e: schedule_tiles_update())
 
     # Hook up click for tile selection
     ctx.tiles_canvas.bind('<Button-1>', tiles_canvas_clicked)
     ctx.tiles_canvas.bind('<Button-3>', tiles_canvas_alt_clicked)
+    ctx.tiles_canvas.bind('<Shift-Button-1>', tiles_canvas_shift_clicked)
+    ctx.tiles_canvas.bind('<Control-Button-1>', tiles_canvas_control_clicked)
+    ctx.tiles_canvas.bind('<Motion>', tiles_canvas_motion)
 
     # Create status bar
     ctx.status_left = StringVar()
@@ -1930,4 +3136,6 @@ def main():
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(run_headless(sys.argv[1:]))
     main()
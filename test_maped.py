@@ -0,0 +1,193 @@
+from array import array
+import random
+
+import png
+import pytest
+
+import maped
+
+
+def rle_decode(data):
+    # PackBits: 0-127 is followed by n + 1 literals, 129-255 by one byte repeated 257 - n times
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        n = data[i]
+        if n < 128:
+            out += data[i + 1:i + n + 2]
+            i += n + 2
+        else:
+            assert n != 128
+            out += data[i + 1:i + 2] * (257 - n)
+            i += 2
+    return bytes(out)
+
+
+def column_rle_decode(data, columns):
+    offsets = [int.from_bytes(data[i:i + 2], 'little') for i in range(0, 2 * columns, 2)] + [len(data)]
+    return b''.join([rle_decode(data[offsets[i]:offsets[i + 1]]) for i in range(columns)])
+
+
+def lz4_decode(data):
+    # LZ4 block format, checking the end of block rules the Z80 depackers rely on
+    def length(n, i):
+        if n == 15:
+            while True:
+                n += data[i]
+                i += 1
+                if data[i - 1] != 255:
+                    break
+        return (n, i)
+
+    out = bytearray()
+    matches = []
+    i = 0
+    while True:
+        token = data[i]
+        (literals, i) = length(token >> 4, i + 1)
+        out += data[i:i + literals]
+        i += literals
+        if i == len(data):
+            assert token & 15 == 0
+            break
+        offset = data[i] | (data[i + 1] << 8)
+        (match, i) = length(token & 15, i + 2)
+        assert 0 < offset <= len(out)
+        matches.append(len(out))
+        for j in range(match + 4):
+            out.append(out[-offset])
+        matches.append(len(out))
+    for (start, end) in zip(matches[::2], matches[1::2]):
+        assert start <= len(out) - 12 and end <= len(out) - 5
+    return bytes(out)
+
+
+def codec_inputs():
+    inputs = [b'', b'a', b'ab', b'aa', b'aaaa', b'abcabcabcab', b'aaaaaaaaaaaa', b'abcdabcdabcda',
+              bytes(128), bytes(129), bytes(1000), bytes(range(256)) * 3]
+    rng = random.Random(0)
+    for n in range(200):
+        size = rng.randint(0, 2000)
+        symbols = rng.choice([1, 2, 4, 256])
+        data = bytearray()
+        while len(data) < size:
+            data += bytes([rng.randrange(symbols)]) * rng.choice([1, 1, 2, 3, 5, 40, 200])
+        inputs.append(bytes(data[:size]))
+    return inputs
+
+
+def test_rle_round_trip():
+    for data in codec_inputs():
+        assert rle_decode(maped.encode_binary(data, 'rle')) == data
+
+
+def test_column_rle_round_trip():
+    for data in codec_inputs():
+        for column_size in (1, 7, 16):
+            columns = (len(data) + column_size - 1) // column_size
+            assert column_rle_decode(maped.encode_binary(data, 'column-rle', column_size), columns) == data
+
+
+def test_lz4_round_trip():
+    for data in codec_inputs():
+        assert lz4_decode(maped.encode_binary(data, 'lz4')) == data
+
+
+def make_document(width, height):
+    doc = maped.Document()
+    doc.width = width
+    doc.height = height
+    doc.tiles = [bytes(32)] * 256
+    doc.map = array('H', [(x * 7 + y) % 256 for x in range(width) for y in range(height)])
+    doc.tags = bytearray(width * height)
+    return doc
+
+
+def test_column_rle_offsets():
+    doc = make_document(4, 8)
+    (data, raw_size) = maped.export_binary(doc, 'map', codec='column-rle')
+    assert raw_size == 32
+    offsets = [int.from_bytes(data[i:i + 2], 'little') for i in range(0, 8, 2)]
+    assert offsets[0] == 8
+    assert offsets == sorted(offsets)
+
+
+def test_column_rle_too_large():
+    # 300 columns of 256 unrepeated bytes put the last column well past 64 KiB
+    doc = make_document(300, 256)
+    with pytest.raises(ValueError):
+        maped.export_binary(doc, 'map', codec='column-rle')
+
+
+def test_import_png_too_many_tiles(tmp_path):
+    # The image's one 16x2 mode 2 tile is new, so it needs an index past the existing tiles
+    tiles = [i.to_bytes(4, 'little') for i in range(0x10000)]
+    filename = str(tmp_path / 'tile.png')
+    with open(filename, 'wb') as f:
+        png.Writer(16, 2, palette=[(0, 0, 0), (255, 255, 255)], bitdepth=1).write(f, [[1] * 16] * 2)
+    assert len(maped.import_png(filename, 2, 16, 2, tiles[:maped.TILE_INDEX])[3]) == maped.TILE_INDEX + 1
+    for count in (maped.TILE_INDEX + 1, len(tiles)):
+        with pytest.raises(ValueError):
+            maped.import_png(filename, 2, 16, 2, tiles[:count])
+
+
+def test_tileless_map_tag_edits():
+    doc = maped.Document()
+    doc.resize(3, 3)
+    doc.dedupe_cell_tags()
+    doc.remove_unused_tiles()
+    doc.set_tags(0, 0, 1, 1, 5)
+    assert doc.tags[0] == 5
+    doc.undo()
+    assert doc.tags[0] == 0
+    assert doc.get_unique_cell_tags() == {}
+
+
+def test_tileless_map_paste():
+    doc = make_document(4, 4)
+    clipboard = doc.copy(0, 0, 2, 2)
+    tileless = maped.Document()
+    tileless.resize(5, 5)
+    tileless.paste(clipboard, 1, 1)
+    tileless.copy(0, 0, 2, 2, cut=True)
+    assert len(tileless.map) == 0 and len(tileless.tags) == 25
+    doc.paste(tileless.copy(0, 0, 3, 3), 0, 0)
+    assert len(doc.map) == len(doc.tags) == 16
+    doc.undo()
+    tileless.undo()
+    tileless.undo()
+    assert len(tileless.map) == 0 and len(tileless.tags) == 25
+
+
+def test_fills_undo_separately():
+    doc = make_document(4, 4)
+    original = doc.map[0]
+    doc.fill(0, 0, 2, 2, 10)
+    doc.fill(0, 0, 2, 2, 20)
+    doc.undo()
+    assert doc.map[0] == 10
+    doc.undo()
+    assert doc.map[0] == original
+
+
+def test_export_flips_setting(tmp_path):
+    # The map's 256 tiles and unflipped cells export as they are unless flips are set
+    doc = make_document(4, 8)
+    (data, raw_size) = maped.export_binary(doc, 'map')
+    assert data == bytes(list(doc.map))
+    doc.flips = True
+    with pytest.raises(ValueError):
+        maped.export_binary(doc, 'map')
+    assert maped.export_binary(doc, 'map', flips=False)[0] == data
+    doc.tiles = doc.tiles[:64]
+    doc.map = array('H', [value % 64 for value in doc.map])
+    doc.map[1] |= maped.TILE_HFLIP
+    assert maped.export_binary(doc, 'map')[0][1] == (doc.map[1] & maped.TILE_INDEX) | 0x80
+
+    filename = str(tmp_path / 'flips.map')
+    doc.write(filename)
+    doc.map[1] &= maped.TILE_INDEX
+    doc.write(filename)
+    loaded = maped.Document()
+    loaded.read(filename)
+    assert loaded.flips and loaded.map == doc.map